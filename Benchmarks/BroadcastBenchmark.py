@@ -0,0 +1,95 @@
+'''
+Compares fanning a message out the way process_message used to (format and
+encode a fresh copy for every recipient) with Server.deliver, which encodes
+once and shares the bytes across every recipient's outbox.
+
+Run from the repository root:
+
+    python3 -m Benchmarks.BroadcastBenchmark
+'''
+
+import argparse
+import contextlib
+import io
+import timeit
+
+from framing import encode_frame
+from server import Server
+
+
+class SinkOutbox:
+    """Stands in for a client outbox and keeps whatever it was handed"""
+
+    compress = False
+
+    def __init__(self):
+        self.queued = []
+
+    def send(self, data, block=False, stamp=None):
+        self.queued.append(data)
+        return True
+
+    def clear(self):
+        self.queued.clear()
+
+
+def per_recipient(server, sender, message, recipients):
+    """The previous fan-out: one formatted, encoded copy per recipient"""
+    for recipient in recipients:
+        server.clients[recipient].send(encode_frame(f"msg {sender} {message}"))
+
+
+def encode_once(server, sender, message, recipients):
+    server.deliver(encode_frame(f"msg {sender} {message}"), recipients, sender)
+
+
+def copied_bytes(outboxes):
+    """Total size of the distinct payload objects held by the outboxes"""
+    distinct = {}
+    for outbox in outboxes:
+        for payload in outbox.queued:
+            distinct[id(payload)] = len(payload)
+    return sum(distinct.values())
+
+
+def measure(server, strategy, message, recipients, number):
+    outboxes = [server.clients[r] for r in recipients]
+
+    def run():
+        strategy(server, "sender", message, recipients)
+        for outbox in outboxes:
+            outbox.clear()
+
+    seconds = min(timeit.repeat(run, number=number, repeat=3)) / number
+    strategy(server, "sender", message, recipients)
+    copied = copied_bytes(outboxes)
+    for outbox in outboxes:
+        outbox.clear()
+    return seconds * 1e6, copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode-once broadcast benchmark")
+    parser.add_argument("--recipients", type=int, nargs="*", default=[1, 4, 16, 64, 256])
+    parser.add_argument("--sizes", type=int, nargs="*", default=[64, 4096, 65536])
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    server = Server("127.0.0.1", 0)
+    print(f"{'recipients':>10} {'payload':>8} {'per-recipient us':>17} {'encode-once us':>15} "
+          f"{'copied bytes':>13} {'shared bytes':>13}")
+
+    for size in args.sizes:
+        message = "x" * size
+        for count in args.recipients:
+            recipients = [f"user{i}" for i in range(count)]
+            server.clients = {r: SinkOutbox() for r in recipients}
+            # deliver() is silent for connected recipients, but keep stdout clean regardless
+            with contextlib.redirect_stdout(io.StringIO()):
+                old_us, old_bytes = measure(server, per_recipient, message, recipients, args.number)
+                new_us, new_bytes = measure(server, encode_once, message, recipients, args.number)
+            print(f"{count:>10} {size:>8} {old_us:>17.2f} {new_us:>15.2f} {old_bytes:>13} {new_bytes:>13}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+'''
+Bytes on the wire and CPU time of frame compression. A file is cut into the
+chunk frames the client sends (CHUNK_SIZE each), every frame is compressed
+the way compress_frame does it at each zlib level, and the inflate on the
+receiving side is timed too. Frames under COMPRESS_THRESHOLD are left alone,
+and so are frames compression would not shrink.
+
+The default sizes are the FileSharingTest files (2200 to 3000 random
+letters) plus a larger file; the same sizes are run over repetitive chat
+text and over random bytes, which do not compress at all.
+
+Run from the repository root:
+
+    python3 -m Benchmarks.CompressionBenchmark
+'''
+
+import argparse
+import os
+import random
+import string
+import time
+
+from client import CHUNK_SIZE
+from framing import COMPRESS_THRESHOLD, HEADER, HEADER_SIZE, compress_frame, inflate
+
+CONTENTS = {
+    "letters": lambda size: "".join(random.choice(string.ascii_letters) for _ in range(size)).encode(),
+    "chat": lambda size: (b"msg 2 alice bob are we still on for lunch at noon? " * (size // 51 + 1))[:size],
+    "random": os.urandom,
+}
+
+
+def chunk_frames(data):
+    return [HEADER.pack(len(data[i:i + CHUNK_SIZE])) + data[i:i + CHUNK_SIZE]
+            for i in range(0, len(data), CHUNK_SIZE)]
+
+
+def measure(frames, level, number):
+    """(bytes on the wire, compress us, inflate us) for sending every frame once"""
+    wire = 0
+    packed = []
+    start = time.perf_counter()
+    for _ in range(number):
+        wire = 0
+        packed = []
+        for frame in frames:
+            compressed = compress_frame(frame, level) if len(frame) >= COMPRESS_THRESHOLD else None
+            packed.append(compressed)
+            wire += len(compressed if compressed is not None else frame)
+    compress_us = (time.perf_counter() - start) / number * 1e6
+
+    start = time.perf_counter()
+    for _ in range(number):
+        for compressed in packed:
+            if compressed is not None:
+                inflate(memoryview(compressed)[HEADER_SIZE:])
+    inflate_us = (time.perf_counter() - start) / number * 1e6
+    return wire, compress_us, inflate_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame compression benchmark")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[2200, 3000, 1024 * 1024])
+    parser.add_argument("--levels", type=int, nargs="*", default=[1, 6, 9])
+    parser.add_argument("--contents", nargs="*", choices=sorted(CONTENTS), default=sorted(CONTENTS))
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'content':>8} {'size':>8} {'level':>5} {'raw bytes':>10} {'wire bytes':>10} "
+          f"{'ratio':>6} {'compress us':>12} {'inflate us':>11}")
+    for content in args.contents:
+        for size in args.sizes:
+            frames = chunk_frames(CONTENTS[content](size))
+            raw = sum(len(frame) for frame in frames)
+            for level in args.levels:
+                wire, compress_us, inflate_us = measure(frames, level, args.number)
+                print(f"{content:>8} {size:>8} {level:>5} {raw:>10} {wire:>10} "
+                      f"{wire / raw:>6.2f} {compress_us:>12.1f} {inflate_us:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
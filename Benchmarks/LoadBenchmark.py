@@ -0,0 +1,298 @@
+'''
+Load benchmark: starts server.py the way TestChatApp does, then drives it with
+thousands of synthetic clients that all live in this process on one asyncio
+loop (no python3 subprocess per client). Reports join throughput, delivered
+messages per second, p50/p99 delivery latency and the server's memory.
+
+Run from the repository root:
+
+    python3 -m Benchmarks.LoadBenchmark --clients 2000 --fanout 8 --size 256
+    python3 -m Benchmarks.LoadBenchmark --mode asyncio --json > baseline.json
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from framing import encode_frame, read_frame
+from server import raise_fd_limit
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_tree(pid):
+    """pid and every descendant, so --workers clusters are measured whole"""
+    pids = [pid]
+    for p in pids:
+        try:
+            for tid in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{tid}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def memory_mb(pid):
+    """(VmRSS, VmHWM) in MB summed over the server's process tree"""
+    rss = hwm = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("VmHWM:"):
+                        hwm += int(line.split()[1])
+        except OSError:
+            pass
+    return rss / 1024, hwm / 1024
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class SyntheticClient(object):
+    """
+    One chat connection. Message bodies carry the perf_counter_ns() they
+    were sent at, which is comparable here because every client shares this
+    process's clock.
+    """
+
+    def __init__(self, name, stats):
+        self.name = name
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.joined = None
+
+    async def join(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.joined = asyncio.get_running_loop().create_future()
+        self.writer.write(encode_frame(self.name))
+        # The server says nothing on a successful join; an echo to ourselves
+        # proves we are registered
+        self.writer.write(encode_frame(f"msg 1 {self.name} joined"))
+        await self.writer.drain()
+        asyncio.get_running_loop().create_task(self.receive())
+        await self.joined
+
+    async def receive(self):
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                if frame is None:
+                    break
+                fields = bytes(frame[:64]).split(b" ", 3)
+                if fields[0] != b"msg":
+                    if not self.joined.done():
+                        self.joined.set_exception(ConnectionError(bytes(frame).decode()))
+                    continue
+                if fields[2] == b"joined":
+                    self.joined.set_result(None)
+                    continue
+                self.stats.delivered(time.perf_counter_ns() - int(fields[2]))
+        except (OSError, ValueError, IndexError):
+            pass
+        finally:
+            if not self.joined.done():
+                self.joined.set_exception(ConnectionError("connection closed"))
+
+    async def send(self, names, count, fanout, padding, interval):
+        for _ in range(count):
+            recipients = random.sample(names, fanout)
+            self.writer.write(encode_frame(
+                f"msg {fanout} {' '.join(recipients)} {time.perf_counter_ns()} {padding}"
+            ))
+            self.stats.sent += 1
+            await self.writer.drain()
+            if interval:
+                await asyncio.sleep(interval)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class LoadStats(object):
+    def __init__(self):
+        self.sent = 0
+        self.latencies = []
+        self.last_delivery = 0.0
+        self.expected = 0
+        self.done = None
+
+    def delivered(self, latency_ns):
+        self.latencies.append(latency_ns / 1e6)
+        self.last_delivery = time.perf_counter()
+        if len(self.latencies) >= self.expected and self.done and not self.done.done():
+            self.done.set_result(None)
+
+
+class LoadBenchmark(object):
+    def __init__(self, args):
+        self.args = args
+        self.host = "127.0.0.1"
+        self.port = args.port or free_port()
+        self.stats = LoadStats()
+        self.clients = [SyntheticClient(f"load{i}", self.stats) for i in range(args.clients)]
+        self.server = None
+
+    def start_server(self):
+        command = [
+            sys.executable, self.args.server, "-p", str(self.port), "-a", self.host,
+            "-m", self.args.mode, "--max-clients", str(self.args.clients),
+            "--queue-size", str(self.args.queue_size), "--log-mode", self.args.log_mode,
+        ]
+        if self.args.workers > 1:
+            command += ["--workers", str(self.args.workers)]
+        # Drain the server's output through a pipe, as the test harness does
+        self.server = subprocess.Popen(command, stdout=subprocess.PIPE)
+        threading.Thread(target=self.discard_output, daemon=True).start()
+
+        deadline = time.time() + 10.0
+        while time.time() < deadline:
+            try:
+                socket.create_connection((self.host, self.port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("server did not start listening")
+
+    def discard_output(self):
+        while self.server.stdout.read1(65536):
+            pass
+
+    def stop_server(self):
+        if self.server.poll() is None:
+            self.server.send_signal(signal.SIGINT)
+            try:
+                self.server.wait(5.0)
+            except subprocess.TimeoutExpired:
+                self.server.kill()
+
+    async def join_all(self):
+        # Bound concurrent connects so the listen backlog isn't what we measure
+        gate = asyncio.Semaphore(self.args.connect_concurrency)
+
+        async def join(client):
+            async with gate:
+                await client.join(self.host, self.port)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(join(c) for c in self.clients))
+        return time.perf_counter() - start
+
+    async def exchange(self):
+        args = self.args
+        names = [c.name for c in self.clients]
+        padding = "x" * args.size
+        interval = 1.0 / args.rate if args.rate else 0
+        self.stats.expected = len(self.clients) * args.messages * args.fanout
+        self.stats.done = asyncio.get_running_loop().create_future()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            c.send(names, args.messages, args.fanout, padding, interval) for c in self.clients
+        ))
+        try:
+            await asyncio.wait_for(self.stats.done, args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        return max(self.stats.last_delivery, start) - start
+
+    async def run_async(self):
+        join_seconds = await self.join_all()
+        joined_rss, _ = memory_mb(self.server.pid)
+        exchange_seconds = await self.exchange()
+        rss, hwm = memory_mb(self.server.pid)
+        for client in self.clients:
+            client.close()
+        return join_seconds, joined_rss, exchange_seconds, rss, hwm
+
+    def run(self):
+        raise_fd_limit()
+        self.start_server()
+        try:
+            join_seconds, joined_rss, exchange_seconds, rss, hwm = asyncio.run(self.run_async())
+        finally:
+            self.stop_server()
+
+        latencies = sorted(self.stats.latencies)
+        delivered = len(latencies)
+        return {
+            "mode": self.args.mode,
+            "workers": self.args.workers,
+            "clients": len(self.clients),
+            "fanout": self.args.fanout,
+            "payload": self.args.size,
+            "sent": self.stats.sent,
+            "delivered": delivered,
+            "expected": self.stats.expected,
+            "joins_per_sec": len(self.clients) / join_seconds if join_seconds else 0.0,
+            "msgs_per_sec": delivered / exchange_seconds if exchange_seconds else 0.0,
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+            "rss_joined_mb": joined_rss,
+            "rss_mb": rss,
+            "hwm_mb": hwm,
+        }
+
+
+def report(result):
+    print(f"{result['clients']} clients, fan-out {result['fanout']}, {result['payload']} byte payloads "
+          f"({result['mode']}, {result['workers']} worker(s))")
+    print(f"  joins/sec      {result['joins_per_sec']:>12.0f}")
+    print(f"  delivered      {result['delivered']:>12} of {result['expected']}")
+    print(f"  msgs/sec       {result['msgs_per_sec']:>12.0f}")
+    print(f"  p50 latency    {result['p50_ms']:>12.2f} ms")
+    print(f"  p99 latency    {result['p99_ms']:>12.2f} ms")
+    print(f"  server RSS     {result['rss_joined_mb']:>12.1f} MB after joins, "
+          f"{result['rss_mb']:.1f} MB at the end (peak {result['hwm_mb']:.1f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server load benchmark")
+    parser.add_argument("--server", default="server.py", help="The path to the Server implementation")
+    parser.add_argument("--port", type=int, default=0, help="Server port, defaults to a free one")
+    parser.add_argument("-m", "--mode", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=20, help="Messages each client sends")
+    parser.add_argument("--fanout", type=int, default=4, help="Recipients per message")
+    parser.add_argument("--size", type=int, default=128, help="Payload bytes per message")
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="Messages per second per client, 0 to send as fast as possible")
+    parser.add_argument("--queue-size", type=int, default=1024)
+    parser.add_argument("--log-mode", choices=["sync", "async"], default="sync")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="Seconds to wait for outstanding deliveries after the last send")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+    args.fanout = min(args.fanout, args.clients)
+
+    result = LoadBenchmark(args).run()
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+'''
+Compares parsing a msg command the way process_message used to (decode the
+whole frame, split it on whitespace and join the body back together) with
+protocol.parse_command, which decodes only the header words and hands the
+body on as a view of the received bytes. Both sides end with the frame that
+goes out to the recipients.
+
+Run from the repository root:
+
+    python3 -m Benchmarks.ParserBenchmark
+'''
+
+import argparse
+import timeit
+
+from framing import encode_frame, encode_parts
+from protocol import parse_command
+
+
+def split_join(frame, sender):
+    """The previous parser: decode, split() and re-join the body"""
+    msg_parts = str(frame, "utf-8").split()
+    num_recipients = int(msg_parts[1])
+    recipients = msg_parts[2:2+num_recipients]
+    message = " ".join(msg_parts[2+num_recipients:])
+    return recipients, encode_frame(f"msg {sender} {message}")
+
+
+def zero_copy(frame, sender):
+    command = parse_command(frame)
+    return command.recipients, encode_parts(b"msg ", sender.encode(), b" ", command.body)
+
+
+def body_of(size):
+    """Chat-like text of the given size: words of a few letters"""
+    words = ("lorem ipsum dolor sit amet " * (size // 27 + 1))[:size]
+    return words.rstrip() + "x" * (size - len(words.rstrip()))
+
+
+def measure(parser, frame, number):
+    seconds = min(timeit.repeat(lambda: parser(frame, "sender"), number=number, repeat=3))
+    return seconds / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Command parser benchmark")
+    parser.add_argument("--recipients", type=int, default=4)
+    parser.add_argument("--sizes", type=int, nargs="*", default=[16, 256, 4096, 65536, 1048576])
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    recipients = " ".join(f"user{i}" for i in range(args.recipients))
+    print(f"{'payload':>8} {'split/join us':>14} {'zero-copy us':>13} {'speedup':>8}")
+
+    for size in args.sizes:
+        frame = memoryview(f"msg {args.recipients} {recipients} {body_of(size)}".encode())
+        # Both parsers have to produce the same outgoing frame
+        assert split_join(frame, "sender") == zero_copy(frame, "sender")
+
+        old_us = measure(split_join, frame, args.number)
+        new_us = measure(zero_copy, frame, args.number)
+        print(f"{size:>8} {old_us:>14.2f} {new_us:>13.2f} {old_us / new_us:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
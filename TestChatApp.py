@@ -1,10 +1,20 @@
 import os
+import io
+import shutil
+import select
+import selectors
 import socket
 import subprocess
+import tempfile
 import time
 import random
 import signal
 import argparse
+import contextlib
+import importlib.util
+import multiprocessing
+import threading
+from framing import HEADER, HEADER_SIZE, recv_exactly
 from Tests import (
     SingleClientTest,
     BasicTest,
@@ -14,6 +24,8 @@ from Tests import (
 )
 
 total_passed = 0
+HELLO_LIMIT = 1024  # a client's first frame, its username, is never longer
+JOIN_SETTLE = 0.2  # seconds to wait for the server's answer to a hello
 
 
 def delete_with_rm_rf():
@@ -28,15 +40,16 @@ def delete_with_rm_rf():
         print(f"Failed to delete files matching pattern: {e}")
 
 
+test_map = {
+    "SingleClient": SingleClientTest.SingleClientTest,
+    "MultipleClients": MultipleClientsTest.MultipleClientsTest,
+    "FileSharing": FileSharingTest.FileSharingTest,
+    "ErrorHandling": ErrorHandlingTest.ErrorHandlingTest,
+}
+
+
 def tests_to_run(forwarder, selected_tests, verbose):
     """Runs the selected tests or all tests if none specified."""
-    test_map = {
-        "SingleClient": SingleClientTest.SingleClientTest,
-        "MultipleClients": MultipleClientsTest.MultipleClientsTest,
-        "FileSharing": FileSharingTest.FileSharingTest,
-        "ErrorHandling": ErrorHandlingTest.ErrorHandlingTest,
-    }
-
     if selected_tests:
         for test_name in selected_tests:
             if test_name in test_map:
@@ -48,8 +61,122 @@ def tests_to_run(forwarder, selected_tests, verbose):
             test_class(forwarder, test_name, verbose=verbose)
 
 
+def free_port():
+    """A port nothing is listening on right now, picked by the kernel."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("", 0))
+        return s.getsockname()[1]
+
+
+def run_isolated(test_name, client_path, server_path, verbose, in_process=False):
+    """
+    Runs one test in its own scratch directory on its own ports, so it can't
+    collide with tests running next to it. Returns (passed, printed output).
+    """
+    global total_passed
+    workdir = tempfile.mkdtemp(prefix=f"chat_{test_name}_")
+    os.chdir(workdir)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            f = Forwarder(client_path, server_path, free_port(), in_process)
+            f.receiver_port = free_port()
+            tests_to_run(f, [test_name], verbose=verbose)
+            f.execute_tests()
+        except Exception as e:
+            print(f"\033[91mTest Failed due to an exception!\033[0m {e}")
+        if total_passed:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"Outputs kept in {workdir}")
+    return bool(total_passed), output.getvalue()
+
+
+def run_parallel(client_path, server_path, selected_tests, verbose, jobs, in_process=False):
+    """
+    Runs each test in a separate process at the same time and prints their
+    output in order. Returns how many passed.
+    """
+    names = [t for t in (selected_tests or test_map) if t in test_map]
+    for t in set(selected_tests or []) - set(names):
+        print(f"Unknown test: {t}")
+    if not names:
+        return 0
+
+    # A fresh process per test keeps the working directory and total_passed apart
+    context = multiprocessing.get_context("fork")
+    passed = 0
+    with context.Pool(jobs or len(names), maxtasksperchild=1) as pool:
+        runs = [
+            pool.apply_async(run_isolated, (name, client_path, server_path, verbose, in_process))
+            for name in names
+        ]
+        for run in runs:
+            ok, output = run.get()
+            print(output, end="")
+            passed += ok
+    return passed
+
+
+class InProcessClient(object):
+    """
+    Runs a client.Client on threads inside the test process, behind the
+    parts of the Popen interface the Forwarder uses: stdin is a real pipe the
+    client reads its input from, and its output goes straight to stdout.
+    """
+
+    def __init__(self, client_class, username, port, stdout):
+        read_end, write_end = os.pipe()
+        self.stdin = os.fdopen(write_end, "wb")
+        self.client = client_class(
+            username, "127.0.0.1", port, stdin=os.fdopen(read_end, "r"), stdout=stdout
+        )
+        self.threads = [
+            threading.Thread(target=self.client.receive_handler, daemon=True),
+            threading.Thread(target=self.run, daemon=True),
+        ]
+        for t in self.threads:
+            t.start()
+
+    def run(self):
+        try:
+            self.client.start()
+        except Exception as e:
+            print(f"Error: {e}", file=self.client.stdout)
+        finally:
+            self.client.stdin.close()
+
+    def poll(self):
+        return None if any(t.is_alive() for t in self.threads) else 0
+
+    def wait(self, timeout=None):
+        for t in self.threads:
+            t.join(timeout)
+        return self.poll()
+
+    def send_signal(self, sig):
+        # Closest thing to interrupting a thread: cut off its input and socket
+        try:
+            self.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.client.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.wait(1.0)
+
+
+def load_client_class(path):
+    """The Client class of the client implementation at path"""
+    spec = importlib.util.spec_from_file_location("chat_client", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Client
+
+
 class Forwarder(object):
-    def __init__(self, sender_path, receiver_path, port):
+    def __init__(self, sender_path, receiver_path, port, in_process=False):
         if not os.path.exists(sender_path):
             raise ValueError("Could not find sender path: %s" % sender_path)
         self.sender_path = sender_path
@@ -57,6 +184,7 @@ class Forwarder(object):
         if not os.path.exists(receiver_path):
             raise ValueError("Could not find receiver path: %s" % receiver_path)
         self.receiver_path = receiver_path
+        self.client_class = load_client_class(sender_path) if in_process else None
 
         self.tests = {}  # test object => testName
         self.current_test = None
@@ -80,15 +208,21 @@ class Forwarder(object):
 
     def _tick(self):
         self.current_test.handle_tick(self.tick_interval)
+        self._flush()
+
+    def _flush(self):
         for p, user in self.out_queue:
             self._send(p, user)
         self.out_queue = []
 
     def _send(self, message, user):
-        if message.receiver == "clientside":
-            self.middle_clientside[user].send(message.message)
-        elif message.receiver == "serverside":
-            self.middle_serverside[user].send(message.message)
+        try:
+            if message.receiver == "clientside":
+                self.middle_clientside[user].sendall(message.message)
+            elif message.receiver == "serverside":
+                self.middle_serverside[user].sendall(message.message)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # that end already hung up, e.g. a client the server turned away
 
     def register_test(self, testcase, testName):
         assert isinstance(testcase, BasicTest.BasicTest)
@@ -97,7 +231,7 @@ class Forwarder(object):
     def execute_tests(self):
         for t in self.tests:
             try:
-                self.port = random.randint(2000, 65500)
+                self.port = free_port()
                 self.current_test = t
                 self.current_test.set_state()
 
@@ -115,7 +249,7 @@ class Forwarder(object):
                     self.middle_serverside[client] = socket.socket(
                         socket.AF_INET, socket.SOCK_STREAM
                     )
-                    self.middle_serverside[client].settimeout(0.01)
+                    self.middle_serverside[client].settimeout(self.timeout)
 
                 print(("Testing %s" % self.tests[t]))
                 # print(f"Tests: {self.tests}")
@@ -132,6 +266,49 @@ class Forwarder(object):
         self.in_queue.append((m, user))
         self.current_test.handle_message()
 
+    def connect_to_receiver(self, user):
+        # The receiver may still be importing when the first client arrives
+        deadline = time.time() + 2.0
+        while True:
+            try:
+                self.middle_serverside[user].connect(self.receiver_addr)
+                return
+            except ConnectionRefusedError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.01)
+                self.middle_serverside[user].close()
+                self.middle_serverside[user] = socket.socket(
+                    socket.AF_INET, socket.SOCK_STREAM
+                )
+                self.middle_serverside[user].settimeout(self.timeout)
+
+    def forward_hello(self, user):
+        """
+        Passes a new client's hello on to the server and waits for the
+        server's answer (or JOIN_SETTLE seconds), so clients join in the
+        order they were started rather than whichever handshake finishes
+        first. Joins and rejections are decided before the next client starts.
+        """
+        conn = self.middle_clientside[user]
+        server = self.middle_serverside[user]
+        header = recv_exactly(conn, HEADER_SIZE)
+        if header is None:
+            return
+        (length,) = HEADER.unpack(header)
+        hello = header
+        if length <= HELLO_LIMIT:
+            hello += recv_exactly(conn, length) or b""
+        self.handle_receive(hello, "clientside", user)
+        self._flush()
+
+        readable, _, _ = select.select([server], [], [], JOIN_SETTLE)
+        if readable:
+            reply = server.recv(65536)
+            if reply:
+                self.handle_receive(reply, "serverside", user)
+                self._flush()
+
     def start(self):
         self.receiver_addr = ("127.0.0.1", self.receiver_port)
         self.recv_outfile = "server_out"
@@ -152,57 +329,68 @@ class Forwarder(object):
             sender_out[i] = open("client_" + i, "w")
             if "duplicate" in i:
                 u = i[:7]
-            self.senders[i] = subprocess.Popen(
-                ["python3", self.sender_path, "-p", str(self.port), "-u", u],
-                stdin=subprocess.PIPE,
-                stdout=sender_out[i],
-            )
+            if self.client_class:
+                self.senders[i] = InProcessClient(
+                    self.client_class, u, self.port, sender_out[i]
+                )
+            else:
+                self.senders[i] = subprocess.Popen(
+                    ["python3", self.sender_path, "-p", str(self.port), "-u", u],
+                    stdin=subprocess.PIPE,
+                    stdout=sender_out[i],
+                )
 
             conn, addr = self.sock.accept()
-            conn.settimeout(0.01)
+            conn.settimeout(self.timeout)
             self.middle_clientside[i] = conn
-            self.middle_serverside[i].connect(self.receiver_addr)
+            self.connect_to_receiver(i)
+            self.forward_hello(i)
             # print(f"Client {self.middle_clientside[i]} is starting")
 
+        selector = selectors.DefaultSelector()
         try:
+            for i in self.current_test.client_stdin:
+                selector.register(self.middle_clientside[i], selectors.EVENT_READ, (i, "clientside"))
+                selector.register(self.middle_serverside[i], selectors.EVENT_READ, (i, "serverside"))
+
             client_stdin = dict(self.current_test.client_stdin)
             start_time = time.time()
             self.last_tick = time.time()
-            while None in [self.senders[s].poll() for s in self.senders]:
-                for i in sorted(list(self.current_test.client_stdin.keys())):
+            # Run until every client exited and closed its side of the proxy
+            while None in [self.senders[s].poll() for s in self.senders] or client_stdin:
+                wait = self.tick_interval - (time.time() - self.last_tick)
+                for key, _ in selector.select(max(wait, 0)):
+                    user, side = key.data
                     try:
-                        message = self.middle_clientside[i].recv(4096)
-                        if len(message) != 0:
-                            self.handle_receive(message, "clientside", i)
-                    except socket.timeout:
-                        pass
+                        message = key.fileobj.recv(65536)
+                    except OSError:
+                        message = b""
+                    if message:
+                        self.handle_receive(message, side, user)
+                        self._flush()
+                        continue
+                    # Pass the close on to the other end, as a real connection would
+                    selector.unregister(key.fileobj)
+                    if side == "clientside":
+                        client_stdin.pop(user, None)
+                        other = self.middle_serverside[user]
+                    else:
+                        other = self.middle_clientside[user]
                     try:
-                        message = self.middle_serverside[i].recv(4096)
-                        if len(message) != 0:
-                            self.handle_receive(message, "serverside", i)
-                    except socket.timeout:
+                        other.shutdown(socket.SHUT_WR)
+                    except OSError:
                         pass
 
-                    # print(f"Time : {time.time() - self.last_tick} and Timeout : {self.tick_interval}")
-                    if time.time() - self.last_tick > self.tick_interval:
-                        self.last_tick = time.time()
-                        self._tick()
-                    if time.time() - start_time > self.timeout:
-                        raise Exception("Test timed out!")
-            while bool(client_stdin):
-                for i in list(client_stdin.keys()):
-                    try:
-                        message = self.middle_clientside[i].recv(4096)
-                        if len(message) != 0:
-                            self.handle_receive(message, "clientside", i)
-                        else:
-                            del client_stdin[i]
-                    except socket.timeout:
-                        pass
+                if time.time() - self.last_tick > self.tick_interval:
+                    self.last_tick = time.time()
+                    self._tick()
+                if time.time() - start_time > self.timeout:
+                    raise Exception("Test timed out!")
             self._tick()
         except (KeyboardInterrupt, SystemExit):
             exit()
         finally:
+            selector.close()
             for sender in self.senders:
                 if self.senders[sender].poll() is None:
                     self.senders[sender].send_signal(signal.SIGINT)
@@ -213,7 +401,11 @@ class Forwarder(object):
             recv_out.close()
         if not os.path.exists(self.recv_outfile):
             raise RuntimeError("No data received by receiver!")
-        time.sleep(1)
+        try:
+            # The receiver flushes its output on the way out
+            receiver.wait(1)
+        except subprocess.TimeoutExpired:
+            pass
         try:
             result = self.current_test.result()
             if result:
@@ -250,6 +442,8 @@ if __name__ == "__main__":
         print(
             "  --test TESTS      Run specific tests (e.g., SingleClient MultipleClients). Default: Run all tests."
         )
+        print("  --parallel [N]    Run tests at once in separate directories, N at a time (default: all).")
+        print("  --in-process      Run clients as threads in this process instead of subprocesses.")
         print("  --verbose         Enable verbose output for tests.")
         print("  -h, --help        Show this help message and exit.")
         print("\nExample:")
@@ -283,6 +477,19 @@ if __name__ == "__main__":
         default=None,
         help="Run specific tests (e.g., SingleClient MultipleClients)",
     )
+    parser.add_argument(
+        "--parallel",
+        nargs="?",
+        type=int,
+        const=0,
+        default=None,
+        help="Run tests concurrently, each in its own directory and ports",
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Run clients as threads in this process instead of subprocesses",
+    )
     parser.add_argument(
         "--verbose", action="store_true", help="Enable verbose output for tests."
     )
@@ -296,10 +503,20 @@ if __name__ == "__main__":
         usage()
         exit(0)
     try:
-        f = Forwarder(args.client, args.server, args.port)
-        tests_to_run(f, args.test, verbose=args.verbose)
         print("\033[1mChat Application Test Suite\033[0m")
-        f.execute_tests()
+        if args.parallel is not None:
+            total_passed = run_parallel(
+                os.path.abspath(args.client),
+                os.path.abspath(args.server),
+                args.test,
+                args.verbose,
+                args.parallel,
+                args.in_process,
+            )
+        else:
+            f = Forwarder(args.client, args.server, args.port, args.in_process)
+            tests_to_run(f, args.test, verbose=args.verbose)
+            f.execute_tests()
     except Exception as e:
         print(f"\033[91mTest Failed due to an exception!\033[0m {e}")
         exit(1)
@@ -1,6 +1,9 @@
 import hashlib
 import os
 import time
+from collections import Counter
+from framing import FrameBuffer, FrameError
+from .OutputVerifier import OutputVerifier, client_line_sender, server_line_sender
 # import util
 
 
@@ -13,29 +16,99 @@ class BasicTest(object):
         self.input = []
         self.input_to_check = []
         self.last_time = time.time()
-        self.time_interval = 0.5
+        self.time_interval = 0.5  # fallback when the expected packets never show up
+        self.settle_interval = 0.02
         self.verbose = verbose
+        self.streams = {}  # (client, receiver side) => FrameBuffer
+        self.observed = Counter()  # (client, receiver side) => frames forwarded so far
+        self.awaited = None  # frame counts that mean the last input was handled
+        self.joined_at = None
 
     def set_state(self):
         pass
 
     def handle_message(self):
         for m, user in self.forwarder.in_queue:
+            self.observe(m, user)
             self.forwarder.out_queue.append((m, user))
         self.forwarder.in_queue = []
 
+    def observe(self, m, user):
+        """Counts the frames going past the forwarder on each client's connection"""
+        key = (user, m.receiver)
+        stream = self.streams.setdefault(key, FrameBuffer())
+        if stream is None:
+            return
+        try:
+            self.observed[key] += len(stream.feed(m.message))
+        except FrameError:
+            self.streams[key] = None  # not framed; pacing falls back to time_interval
+
+    def expected_packets(self, client, inpt):
+        """
+        Frames the forwarder should see once the server has dealt with inpt,
+        or None when that can't be predicted
+        """
+        msg = inpt.split()
+        if not msg:
+            return None
+        if msg[0] == "list":
+            return Counter({(client, "serverside"): 1, (client, "clientside"): 1})
+        if msg[0] == "msg":
+            try:
+                recipients = msg[2:2 + int(msg[1])]
+            except ValueError:
+                return None
+            expected = Counter({(client, "serverside"): 1})
+            for r in recipients:
+                if r not in self.client_stdin:
+                    return None
+                expected[(r, "clientside")] += 1
+            return expected
+        return None
+
+    def ready(self):
+        """
+        True once the previous input has visibly been handled, or once
+        time_interval has passed without that happening
+        """
+        if not self.input_to_check:
+            return self.clients_joined()
+        elapsed = time.time() - self.last_time
+        if elapsed > self.time_interval:
+            return True
+        if self.awaited is None or elapsed < self.settle_interval:
+            return False
+        return all(self.observed[key] >= n for key, n in self.awaited.items())
+
+    def clients_joined(self):
+        """
+        True time_interval after every client's username has reached the
+        server. Clients are started one after another, so the clock only
+        starts once the last one is in, and the server sends nothing back on
+        a successful join that could be waited for instead.
+        """
+        if None in self.streams.values():
+            return time.time() - self.last_time > self.time_interval
+        if self.joined_at is None:
+            if any(self.observed[(c, "serverside")] < 1 for c in self.client_stdin):
+                return False
+            self.joined_at = time.time()
+        return time.time() - self.joined_at > self.time_interval
+
     def handle_tick(self, tick_interval):
-        if self.last_time is None:
+        if self.last_time is None or not self.ready():
             return
         elif len(self.input) > 0:
-            if time.time() - self.last_time > self.time_interval:
-                client, inpt = self.input[0]
-                self.input_to_check.append((client, inpt))
-                self.input = self.input[1:]
-                self.forwarder.senders[client].stdin.write(inpt.encode())
-                self.forwarder.senders[client].stdin.flush()
-                self.last_time = time.time()
-        elif time.time() - self.last_time > 0.5:
+            client, inpt = self.input[0]
+            self.input_to_check.append((client, inpt))
+            self.input = self.input[1:]
+            expected = self.expected_packets(client, inpt)
+            self.awaited = self.observed + expected if expected is not None else None
+            self.forwarder.senders[client].stdin.write(inpt.encode())
+            self.forwarder.senders[client].stdin.flush()
+            self.last_time = time.time()
+        else:
             for client in self.forwarder.senders.keys():
                 self.forwarder.senders[client].stdin.write("quit\n".encode())
                 self.forwarder.senders[client].stdin.flush()
@@ -84,42 +157,42 @@ class BasicTest(object):
 
         # Validate Clients Output
         for client, expected_output in clients_out.items():
-            with open(f"client_{client}") as f:
-                user_output = f.read().split("\n")
-                missing_lines = [
-                    line for line in expected_output if line not in user_output
-                ]
-
-                if self.verbose:
-                    self.show_verbose_output(
-                        expected_output, user_output, f"Client {client}")
-                if missing_lines:
-                    print(f"\033[91mTest Failed\033[0m: Client {client} output is incorrect.")
-                    print("\nMissing lines (expected but not found):")
-                    for line in missing_lines:
-                        print(f"  - {line}")
-                    return False
+            if not self.check_output(
+                f"client_{client}", expected_output, f"Client {client}", client_line_sender
+            ):
+                return False
 
         # Validate Server Output
-        with open("server_out") as f:
-            user_output = f.read().split("\n")
-            missing_lines = [
-                line for line in server_out if line not in user_output
-            ]
-            
-            if self.verbose:
-                self.show_verbose_output(server_out, user_output, "Server")
-            if missing_lines:
-                print(
-                    f"\033[91mTest Failed\033[0m: Server output is incorrect.")
-                print("\nMissing lines (expected but not found):")
-                for line in missing_lines:
-                    print(f"  - {line}")
-                return False
+        if not self.check_output("server_out", server_out, "Server", server_line_sender):
+            return False
 
         print("\033[92mTest Passed\033[0m")
         return True
 
+    def check_output(self, filename, expected, context, sender_of=None):
+        """
+        Checks that filename holds every expected line, and that lines from
+        the same sender (per sender_of) came out in the expected order.
+        """
+        missing_lines, out_of_order = OutputVerifier(expected, sender_of).verify(filename)
+
+        if self.verbose:
+            with open(filename) as f:
+                self.show_verbose_output(expected, f.read().split("\n"), context)
+        if missing_lines:
+            print(f"\033[91mTest Failed\033[0m: {context} output is incorrect.")
+            print("\nMissing lines (expected but not found):")
+            for line in missing_lines:
+                print(f"  - {line}")
+            return False
+        if out_of_order:
+            print(f"\033[91mTest Failed\033[0m: {context} output is out of order.")
+            print("\nLines printed after a later line from the same sender:")
+            for line in out_of_order:
+                print(f"  - {line}")
+            return False
+        return True
+
     def show_verbose_output(self, expected, actual, context):
         """Display detailed side-by-side comparison of outputs."""
         print(f"\n\033[94mVerbose Output: {context} Comparison\033[0m")
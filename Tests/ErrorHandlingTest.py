@@ -86,38 +86,14 @@ class ErrorHandlingTest(BasicTest):
 
         # Validate client outputs
         for client, expected_output in clients_out.items():
-            with open(f"client_{client}") as f:
-                user_output = f.read().split("\n")
-                missing_lines = [
-                    line for line in expected_output if line not in user_output
-                ]
-
-                if self.verbose:
-                    self.show_verbose_output(
-                        expected_output, user_output, f"Client {client}")
-                if missing_lines:
-                    print(f"\033[91mTest Failed\033[0m: Client {client} output is incorrect.")
-                    print("\nMissing lines (expected but not found):")
-                    for line in missing_lines:
-                        print(f"  - {line}")
-                    return False
+            if not self.check_output(
+                f"client_{client}", expected_output, f"Client {client}", client_line_sender
+            ):
+                return False
 
         # Validate server output
-        with open("server_out") as f:
-            user_output = f.read().split("\n")
-            missing_lines = [
-                line for line in server_out if line not in user_output
-            ]
-
-            if self.verbose:
-                self.show_verbose_output(server_out, user_output, "Server")
-            if missing_lines:
-                print(
-                    f"\033[91mTest Failed\033[0m: Server output is incorrect.")
-                print("\nMissing lines (expected but not found):")
-                for line in missing_lines:
-                    print(f"  - {line}")
-                return False
+        if not self.check_output("server_out", server_out, "Server", server_line_sender):
+            return False
 
         print("\033[92mTest Passed\033[0m")
         return True
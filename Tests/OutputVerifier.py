@@ -0,0 +1,87 @@
+from collections import Counter, deque
+
+# Server lines whose order follows the order of the sender's inputs. Joins and
+# disconnects are left out: the tests list them up front, not where they happen.
+SERVER_EVENTS = ("msg", "file", "request_users_list")
+
+
+def client_line_sender(line):
+    """Sender of a 'msg: <sender>: ...' or 'file: <sender>: ...' client line"""
+    head, _, rest = line.partition(": ")
+    if head in ("msg", "file"):
+        return rest.partition(": ")[0] or None
+    return None
+
+
+def server_line_sender(line):
+    """Client a server line like 'msg: <sender> ...' is about"""
+    head, _, rest = line.partition(": ")
+    if head in SERVER_EVENTS and rest:
+        return rest.split(" ", 1)[0]
+    return None
+
+
+class OutputVerifier(object):
+    """
+    Checks an output file against the lines it is expected to contain.
+
+    Expected lines are counted as a multiset, so a line expected twice has to
+    be printed twice, and the file is streamed once, so memory only grows with
+    the expected lines. When sender_of is given, expected lines with the same
+    sender also have to be printed in the order they are listed. Extra lines
+    in the output are ignored.
+    """
+
+    def __init__(self, expected, sender_of=None):
+        self.expected = list(expected)
+        self.sender_of = sender_of
+
+    def verify(self, filename):
+        """Returns (missing lines, lines printed out of order)"""
+        remaining = Counter(self.expected)
+
+        sequences = {}  # sender => expected lines in order
+        if self.sender_of:
+            for line in self.expected:
+                sender = self.sender_of(line)
+                if sender is not None:
+                    sequences.setdefault(sender, []).append(line)
+        positions = dict.fromkeys(sequences, 0)
+        indices = {}  # sender => line => deque of positions still to be matched
+        for sender, sequence in sequences.items():
+            indices[sender] = {}
+            for i, line in enumerate(sequence):
+                indices[sender].setdefault(line, deque()).append(i)
+        skipped = {sender: Counter() for sender in sequences}
+
+        out_of_order = []
+        with open(filename) as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if remaining[line] > 0:
+                    remaining[line] -= 1
+
+                sender = self.sender_of(line) if sequences else None
+                if sender not in sequences:
+                    continue
+                if skipped[sender][line] > 0:
+                    # Something later from this sender was already printed
+                    skipped[sender][line] -= 1
+                    out_of_order.append(line)
+                    continue
+                queue = indices[sender].get(line)
+                if not queue:
+                    continue
+                position = queue.popleft()
+                sequence = sequences[sender]
+                for i in range(positions[sender], position):
+                    indices[sender][sequence[i]].popleft()
+                    skipped[sender][sequence[i]] += 1
+                positions[sender] = position + 1
+
+        missing = []
+        for line in self.expected:
+            if remaining[line] > 0:
+                remaining[line] -= 1
+                missing.append(line)
+        return missing, out_of_order
@@ -0,0 +1,116 @@
+'''
+Stress test for the client registry: many threads join, route messages, list
+and disconnect against one Server at the same time, the way handler threads
+do under a join/leave storm. Runs without sockets or subprocesses:
+
+    python3 -m Tests.RegistryStressTest
+'''
+
+import argparse
+import contextlib
+import io
+import random
+import sys
+import threading
+
+from server import Server
+
+
+class CountingOutbox(object):
+    """Outbox stand-in that counts what it is sent"""
+
+    compress = False
+
+    def __init__(self):
+        self.received = 0
+        self.closed = False
+
+    def send(self, data, block=False, stamp=None):
+        self.received += 1
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+class StressServer(Server):
+    def make_outbox(self, client_socket, username):
+        return CountingOutbox()
+
+
+class RegistryStressTest(object):
+    def __init__(self, threads=32, rounds=300, names=64, capacity=48):
+        self.threads = threads
+        self.rounds = rounds
+        self.names = [f"user{i}" for i in range(names)]
+        self.server = StressServer("127.0.0.1", 0)
+        self.server.clients.capacity = capacity
+        self.errors = []
+        self.joined = 0
+        self.max_seen = 0
+        self.counter_lock = threading.Lock()
+
+    def worker(self, seed):
+        rng = random.Random(seed)
+        try:
+            for _ in range(self.rounds):
+                name = rng.choice(self.names)
+                outbox = self.server.register_client(name, None)
+                self.max_seen = max(self.max_seen, len(self.server.clients))
+                if outbox is None:
+                    continue
+                with self.counter_lock:
+                    self.joined += 1
+
+                recipients = rng.sample(self.names, 4)
+                self.server.process_message(name, f"msg 4 {' '.join(recipients)} hello from {name}")
+                self.server.process_message(name, "list")
+                self.server.disconnect_client(name, outbox)
+        except Exception as e:
+            self.errors.append(repr(e))
+
+    def run(self):
+        threads = [threading.Thread(target=self.worker, args=(i,)) for i in range(self.threads)]
+        # Switch threads far more often than usual to shake out interleavings
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+        finally:
+            sys.setswitchinterval(interval)
+        return self.result()
+
+    def result(self):
+        problems = list(self.errors)
+        if len(self.server.clients) != 0:
+            problems.append(f"{len(self.server.clients)} clients left registered")
+        if self.server.clients.keys():
+            problems.append(f"names left registered: {self.server.clients.keys()}")
+        if len(self.server.roster) != 0:
+            problems.append(f"names left in roster: {self.server.roster.names()}")
+        if self.max_seen > self.server.clients.capacity:
+            problems.append(f"saw {self.max_seen} clients with capacity {self.server.clients.capacity}")
+        if not self.joined:
+            problems.append("no client ever joined")
+
+        if problems:
+            print("\033[91mTest Failed\033[0m: Registry is inconsistent after the stress run.")
+            for problem in problems:
+                print(f"  - {problem}")
+            return False
+
+        print(f"\033[92mTest Passed\033[0m ({self.joined} joins across {self.threads} threads)")
+        return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Client registry stress test")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=300)
+    args = parser.parse_args()
+    passed = RegistryStressTest(args.threads, args.rounds).run()
+    exit(0 if passed else 1)
@@ -0,0 +1,67 @@
+'''
+Turning users away while the server is too loaded to take them, rather than
+only once a fixed number of them is connected.
+'''
+
+import os
+import threading
+import time
+
+RETRY_AFTER = 5  # seconds a turned-away client is told to wait before retrying
+CHECK_INTERVAL = 0.5  # seconds a load measurement is reused for
+
+
+def resident_memory():
+    """Bytes the process has resident in memory, or None where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class AdmissionControl:
+    '''
+    Limits on the load a server may be under and still admit a user: its
+    resident memory in bytes and the messages waiting in all of its outboxes
+    together. Either limit can be None.
+
+    Measuring walks every outbox, so a measurement is reused for `interval`
+    seconds: a burst of joins costs one walk, not one per join. Users already
+    connected are never dropped; the limits only decide who else gets in.
+    '''
+
+    def __init__(self, queue_depth, max_memory=None, max_queued=None, interval=CHECK_INTERVAL,
+                 clock=time.monotonic):
+        self.queue_depth = queue_depth  # callable: messages currently queued
+        self.max_memory = max_memory
+        self.max_queued = max_queued
+        self.interval = interval
+        self.clock = clock
+        self._measured_at = None
+        self._verdict = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        """
+        None if a user may join now, otherwise which limit is exceeded:
+        "memory" or "queued"
+        """
+        now = self.clock()
+        if self._measured_at is not None and now - self._measured_at < self.interval:
+            return self._verdict
+        with self._lock:
+            if self._measured_at is None or now - self._measured_at >= self.interval:
+                self._verdict = self._measure()
+                self._measured_at = now
+            return self._verdict
+
+    def _measure(self):
+        if self.max_memory is not None:
+            memory = resident_memory()
+            if memory is not None and memory >= self.max_memory:
+                return "memory"
+        if self.max_queued is not None and self.queue_depth() >= self.max_queued:
+            return "queued"
+        return None
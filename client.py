@@ -2,11 +2,20 @@
 This module defines the behaviour of a client in your Chat Application
 '''
 
+import os
 import sys
 import socket
-from threading import Thread
-from dataclasses import dataclass
+from threading import Event, Lock, Thread
+from dataclasses import dataclass, field
+from typing import TextIO
 import argparse
+from framing import COMPRESS_THRESHOLD, COMPRESSION, HEADER, FrameBuffer, FrameError, compress_frame, encode_frame, recv_frames
+
+CHUNK_SIZE = 32 * 1024
+CHUNK_PREFIX = b"chunk "
+CHUNK_HEAD_MAX = 512  # prefix plus the longest username we expect to parse
+PONG = encode_frame("pong")
+QUIT_TIMEOUT = 5.0  # seconds to wait for the server to close the connection after quit
 
 
 @dataclass
@@ -21,11 +30,26 @@ class Client:
     name: str   
     server_addr: str
     server_port: int
-    sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock: socket.socket = field(default_factory=lambda: socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+    stdin: TextIO = None    # where user input is read from, sys.stdin by default
+    stdout: TextIO = None   # where output is printed, sys.stdout by default
+    compress: bool = True   # offer compressed frames at the handshake
 
     def __post_init__(self):
             """Initialize socket settings"""
+            self.stdin = self.stdin or sys.stdin
+            self.stdout = self.stdout or sys.stdout
             self.sock.settimeout(None)
+            self.connected = Event()
+            self.receiver_lock = Lock()
+            self.send_lock = Lock()  # the receiver answers pings while the input loop sends
+            self.sending_file = False  # the server reads every frame as file data until it ends
+            self.pong_owed = False
+            self.receiving = False
+            self.received = Event()  # set once the receiver has seen the connection end
+            self.incoming = {}  # sender => [file object, bytes remaining, filename]
+            self.compressing = False  # set once the server accepts compression
+            self.retry_after = None  # seconds the server asked us to wait if it turned us away
 
     def start(self):
         """
@@ -33,78 +57,245 @@ class Client:
         """
         try:
             self.sock.connect((self.server_addr, self.server_port))
-            self.sock.send(self.name.encode())     #send username to server
+            hello = f"{self.name} {COMPRESSION}" if self.compress else self.name
+            self.sock.sendall(encode_frame(hello))     #send username to server
+            self.connected.set()
             
             # Start message receiver thread
             Thread(target=self.receive_handler, daemon=True).start()
             
             while True:
                 try:
-                    user_input = sys.stdin.readline().strip() 
+                    user_input = self.stdin.readline()
+                    if not user_input:
+                        raise EOFError
+                    user_input = user_input.strip()
                 except EOFError:
-                    print("Error: No input received. Exiting client.")
+                    print("Error: No input received. Exiting client.", file=self.stdout)
                     return
 
                 if user_input == "quit":
-                    self.sock.send("quit".encode())         # notify server before quitting
+                    self.send_frame(encode_frame("quit"))         # notify server before quitting
+                    # Let the receiver see the server close the connection and
+                    # print "quitting" before we return and the process exits
+                    self.sock.shutdown(socket.SHUT_WR)
+                    self.received.wait(QUIT_TIMEOUT)
                     self.sock.close()
                     break
+
+                if user_input.startswith("file "):
+                    self.send_file(user_input)
+                    continue
                     
-                self.sock.send(user_input.encode())             #send message to server
+                self.send_frame(encode_frame(user_input))             #send message to server
 
         except (socket.error, ConnectionResetError, KeyboardInterrupt) as e:
-            print(f"Error: {e}")
-            print("quitting")
+            print(f"Error: {e}", file=self.stdout)
+            print("quitting", file=self.stdout)
         finally:            
             self.sock.close()
     
+    def send_frame(self, frame):
+        """Sends one frame, compressed if the server agreed and it is large enough"""
+        if self.compressing and len(frame) >= COMPRESS_THRESHOLD:
+            frame = compress_frame(frame) or frame
+        with self.send_lock:
+            self.sock.sendall(frame)
+
     def handle_message(self, msg):
         """Handles regular message responses"""
         parts = msg.split(" ", 2)
         if len(parts) == 3:
-            print(f"msg: {parts[1]}: {parts[2].strip()}")
+            print(f"msg: {parts[1]}: {parts[2].strip()}", file=self.stdout)
+        else:
+            print(msg.strip(), file=self.stdout)
+
+    def handle_group_message(self, msg):
+        """Handles a message sent to one of our groups"""
+        parts = msg.split(" ", 3)
+        if len(parts) == 4:
+            print(f"group_msg: {parts[1]}: {parts[2]}: {parts[3].strip()}", file=self.stdout)
         else:
-            print(msg.strip())
+            print(msg.strip(), file=self.stdout)
+
+    def handle_server_full(self, msg):
+        """Handles being turned away, noting when the server suggests trying again"""
+        for option in msg.split()[1:]:
+            key, _, value = option.partition("=")
+            if key == "retry_after":
+                try:
+                    self.retry_after = float(value)
+                except ValueError:
+                    pass
+        print("disconnected: server full", file=self.stdout)
 
     def handle_list(self, msg):
         """Handles list command responses"""
         parts = msg.split(" ", 1)
         if len(parts) == 2:
-            print(f"list: {parts[1].strip()}")
+            print(f"list: {parts[1].strip()}", file=self.stdout)
         else:
-            print(msg.strip())
+            print(msg.strip(), file=self.stdout)
+
+    def send_file(self, user_input):
+        """
+        Streams a file to the server: a header frame announcing its size, then
+        its contents as CHUNK_SIZE frames sent straight from disk with
+        sendfile(), or read and compressed when the server agreed to that
+        """
+        parts = user_input.split()
+        try:
+            num_recipients = int(parts[1])
+            filename = parts[2 + num_recipients]
+        except (ValueError, IndexError):
+            self.send_frame(encode_frame(user_input))
+            return
+
+        try:
+            f = open(filename, "rb")
+        except OSError as e:
+            print(f"Error: {e}", file=self.stdout)
+            return
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            header = " ".join(parts[:3 + num_recipients] + [str(size)])
+            with self.send_lock:
+                self.sending_file = True
+            try:
+                self.send_frame(encode_frame(header))
+                self.send_chunks(f, filename, size)
+            finally:
+                with self.send_lock:
+                    self.sending_file = False
+                    owed, self.pong_owed = self.pong_owed, False
+                if owed:
+                    self.send_frame(PONG)
+
+    def send_chunks(self, f, filename, size):
+        """Sends a file's contents as the raw chunk frames following its header"""
+        offset = 0
+        while offset < size:
+            count = min(CHUNK_SIZE, size - offset)
+            if self.compressing:
+                chunk = f.read(count)
+                if len(chunk) < count:
+                    raise OSError(f"{filename} shrank while it was being sent")
+                self.send_frame(HEADER.pack(count) + chunk)
+                offset += count
+                continue
+            with self.send_lock:
+                self.sock.sendall(HEADER.pack(count))
+                sent = self.sock.sendfile(f, offset, count)
+            if sent < count:
+                raise OSError(f"{filename} shrank while it was being sent")
+            offset += sent
+
+    def answer_ping(self):
+        """
+        Answers the server checking we are still there. Mid-file the pong
+        would be taken for file data, so it waits until the file is sent;
+        the chunks already show the server we are there.
+        """
+        with self.send_lock:
+            if self.sending_file:
+                self.pong_owed = True
+                return
+            self.sock.sendall(PONG)
 
     def handle_file(self, msg):
-        """Handles file transfer responses"""
-        parts = msg.split(" ", 2)
-        if len(parts) == 3:
-            print(f"file: {parts[1]}: {parts[2].strip()}")
+        """Handles the header announcing an incoming file"""
+        parts = msg.split(" ")
+        if len(parts) != 4 or not parts[3].isdigit():
+            print(msg.strip(), file=self.stdout)
+            return
+
+        _, sender, filename, size = parts
+        path = f"{self.name}_{os.path.basename(filename)}"
+        self.incoming[sender] = [open(path, "wb"), int(size), filename]
+        if int(size) == 0:
+            self.finish_file(sender)
+
+    def handle_chunk(self, frame):
+        """Writes one relayed chunk of a file to disk"""
+        head = bytes(frame[:CHUNK_HEAD_MAX])
+        space = head.find(b" ", len(CHUNK_PREFIX))
+        if space < 0:
+            return
+
+        sender = head[len(CHUNK_PREFIX):space].decode()
+        transfer = self.incoming.get(sender)
+        if transfer is None:
+            return
+
+        data = frame[space + 1:]
+        transfer[0].write(data)
+        transfer[1] -= len(data)
+        if transfer[1] <= 0:
+            self.finish_file(sender)
+
+    def finish_file(self, sender):
+        """Closes a completely received file and reports it"""
+        f, _, filename = self.incoming.pop(sender)
+        f.close()
+        print(f"file: {sender}: {filename}", file=self.stdout)
+
+    def dispatch(self, msg):
+        """Routes a single message from the server to its handler"""
+        if msg.startswith("msg"):
+            self.handle_message(msg)
+        elif msg.startswith("group_msg "):
+            self.handle_group_message(msg)
+        elif msg.startswith("list:"):
+            self.handle_list(msg)
+        elif msg.startswith("file:"):
+            self.handle_file(msg)
+        elif msg.startswith("history "):
+            print(f"history: {msg[len('history '):]}", file=self.stdout)
+        elif msg == "ping":
+            self.answer_ping()
+        elif msg == "pong":
+            pass
+        elif msg == COMPRESSION:
+            self.compressing = True
+        elif msg.startswith("err_server_full"):
+            self.handle_server_full(msg)
+        elif msg == "err_username_unavailable":
+            print("disconnected: username not available", file=self.stdout)
+        elif msg == "err_unknown_command":
+            print("incorrect user input format", file=self.stdout)
         else:
-            print(msg.strip())
+            print(msg.strip(), file=self.stdout)
 
     def receive_handler(self):
         """
         Handles incoming messages from the server
         """
+        # Only one thread may read frames off the socket
+        with self.receiver_lock:
+            if self.receiving:
+                return
+            self.receiving = True
+        self.connected.wait()
+
+        buffer = FrameBuffer()
         try:
             while True:
-                msg = self.sock.recv(1024).decode().strip()
-                if not msg:
+                frames = recv_frames(self.sock, buffer)
+                if frames is None:
                     break
-                    
-                if msg.startswith("msg"):
-                    self.handle_message(msg)
-                elif msg.startswith("list:"):
-                    self.handle_list(msg)
-                elif msg.startswith("file:"):
-                    self.handle_file(msg)
-                else:
-                    print(msg.strip())
-                    
-        except (socket.error, EOFError) as e:
-            print(f"Error receiving message: {e}")
+
+                for frame in frames:
+                    if frame[:len(CHUNK_PREFIX)] == CHUNK_PREFIX:
+                        self.handle_chunk(frame)
+                    else:
+                        self.dispatch(str(frame, "utf-8").strip())
+
+        except (socket.error, EOFError, FrameError, UnicodeDecodeError) as e:
+            print(f"Error receiving message: {e}", file=self.stdout)
         finally:
-            print("quitting")
+            print("quitting", file=self.stdout)
+            self.received.set()
 
 
 # Do not change this part of code
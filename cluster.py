@@ -0,0 +1,499 @@
+'''
+Multi-process serving.
+
+N worker processes each run a full Server on the same port (SO_REUSEPORT lets
+the kernel spread incoming connections across them). They are tied together
+by a hub running in the parent process, which every worker connects to over a
+Unix socket speaking the regular length-prefixed frames:
+
+    worker => hub                       hub => worker
+    hello <worker>                      join <username> <worker>
+    claim <username> <request>          leave <username>
+    release <username>                  claimed <request> <result>
+    route <username> <block> <payload>  deliver <username> <block> <payload>
+    group_join <username> <group>       group_join <username> <group>
+    group_leave <username> <group>      group_leave <username> <group>
+
+The hub owns the global username => worker table, so usernames stay unique
+and the user cap holds across workers, and it broadcasts every join and leave
+so each worker's roster (and `list`) covers the whole cluster. A message for
+a user connected to another worker is routed through the hub, which hands the
+already framed payload to the owning worker for delivery. <block> is 1 for
+frames that must wait for queue room rather than be dropped (file headers and
+chunks) and 0 for those left to the recipient's backpressure policy. Group
+membership changes are applied by the worker where they happen and passed on
+to the others the same way, so every worker can fan a group message out itself.
+'''
+
+import asyncio
+import contextvars
+import itertools
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import tempfile
+import threading
+
+from framing import FrameBuffer, FrameError, encode_frame, recv_frames
+from outbox import flatten
+from registry import DEFAULT_SHARDS, ClientRegistry
+
+# (username, result) of a claim a coroutine made ahead of registering the user,
+# so the registry's add() doesn't block the event loop making it again
+claimed = contextvars.ContextVar("claimed", default=None)
+
+
+def split_bus_header(frame, fields):
+    """
+    Splits the first `fields` words, separated by single spaces, off a bus
+    frame and returns them decoded along with a view of whatever follows,
+    byte for byte: the payload is a framed message that may well start with
+    whitespace, unlike a client command (protocol.split_header)
+    """
+    head = bytes(frame[:1024])
+    words = []
+    start = 0
+    for _ in range(fields):
+        end = head.find(b" ", start)
+        if end < 0:
+            words.append(head[start:].decode())
+            return words, memoryview(b"")
+        words.append(head[start:end].decode())
+        start = end + 1
+    return words, frame[start:]
+
+
+class Hub:
+    '''
+    Parent-process side of the bus. One thread per worker connection; all
+    ownership changes happen under a single lock, which also orders the join
+    and leave broadcasts identically for every worker.
+    '''
+
+    def __init__(self, path, capacity=None):
+        self.path = path
+        self.capacity = capacity
+        self.owners = {}  # username => worker id
+        self.groups = {}  # group => usernames, replayed to workers that join late
+        self.workers = {}  # worker id => (socket, send lock)
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+
+    def start(self):
+        threading.Thread(target=self.accept_workers, daemon=True).start()
+
+    def close(self):
+        """Closes the socket and removes it, with the directory made for it"""
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+            os.rmdir(os.path.dirname(self.path))
+        except OSError:
+            pass
+
+    def accept_workers(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve_worker, args=(conn,), daemon=True).start()
+
+    def send(self, worker, payload):
+        conn, send_lock = self.workers[worker]
+        with send_lock:
+            conn.sendall(payload)
+
+    def broadcast(self, payload, exclude=None):
+        for worker in list(self.workers):
+            if worker == exclude:
+                continue
+            try:
+                self.send(worker, payload)
+            except OSError:
+                pass
+
+    def serve_worker(self, conn):
+        buffer = FrameBuffer()
+        worker = None
+        try:
+            while True:
+                frames = recv_frames(conn, buffer)
+                if frames is None:
+                    break
+                for frame in frames:
+                    (cmd, name), payload = split_bus_header(frame, 2)
+                    if cmd == "hello":
+                        worker = name
+                        with self.lock:
+                            self.workers[worker] = (conn, threading.Lock())
+                            for user, owner in self.owners.items():
+                                self.send(worker, encode_frame(f"join {user} {owner}"))
+                            for group, members in self.groups.items():
+                                for user in members:
+                                    self.send(worker, encode_frame(f"group_join {user} {group}"))
+                    elif cmd == "claim":
+                        self.claim(worker, name, bytes(payload).decode())
+                    elif cmd == "release":
+                        with self.lock:
+                            if self.owners.get(name) == worker:
+                                self.forget(name)
+                    elif cmd in ("group_join", "group_leave"):
+                        self.update_group(worker, cmd, name, bytes(payload).decode(), frame)
+                    elif cmd == "route":
+                        self.route(name, payload)
+        except (OSError, FrameError):
+            pass
+        finally:
+            self.drop_worker(worker, conn)
+
+    def route(self, username, payload):
+        """
+        Hands a payload (its block flag included) to the worker that owns
+        username. If that worker's socket fails, only the owner is dropped,
+        never the worker routing.
+        """
+        owner = self.owners.get(username)
+        if owner is None:
+            return
+        try:
+            self.send(owner, encode_frame(b"deliver " + username.encode() + b" " + payload))
+        except KeyError:
+            pass  # the owner went away since
+        except OSError:
+            entry = self.workers.get(owner)
+            if entry is not None:
+                self.drop_worker(owner, entry[0])
+
+    def claim(self, worker, username, request):
+        with self.lock:
+            if self.capacity is not None and len(self.owners) >= self.capacity:
+                result = "err_server_full"
+            elif username in self.owners:
+                result = "err_username_unavailable"
+            else:
+                self.owners[username] = worker
+                self.broadcast(encode_frame(f"join {username} {worker}"))
+                result = "ok"
+            # Sent after the join broadcast, so the claiming worker's roster
+            # already lists the user when its claim returns
+            self.send(worker, encode_frame(f"claimed {request} {result}"))
+
+    def update_group(self, worker, cmd, username, group, frame):
+        with self.lock:
+            if cmd == "group_join":
+                self.groups.setdefault(group, set()).add(username)
+            elif group in self.groups:
+                self.groups[group].discard(username)
+                if not self.groups[group]:
+                    del self.groups[group]
+            # The worker it came from has applied it already
+            self.broadcast(encode_frame(frame), exclude=worker)
+
+    def forget(self, username):
+        """Drops a user that left; workers take them out of their groups on the leave"""
+        del self.owners[username]
+        for group in [g for g, members in self.groups.items() if username in members]:
+            self.groups[group].discard(username)
+            if not self.groups[group]:
+                del self.groups[group]
+        self.broadcast(encode_frame(f"leave {username}"))
+
+    def drop_worker(self, worker, conn):
+        """Forgets a worker that went away, along with every user it owned"""
+        with self.lock:
+            self.workers.pop(worker, None)
+            for user in [u for u, owner in self.owners.items() if owner == worker]:
+                self.forget(user)
+        try:
+            # Also wakes the worker's own thread when another one drops it
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+
+
+class RemoteOutbox:
+    '''
+    Stands in for the outbox of a user connected to another worker; whatever
+    is sent to it is routed through the hub. Frames travel uncompressed; the
+    owning worker compresses them for its client if they agreed on it.
+    '''
+
+    compress = False
+
+    def __init__(self, bus, username):
+        self.bus = bus
+        self.username = username
+
+    def __len__(self):
+        return 0
+
+    def send(self, data, block=False, stamp=None):
+        self.bus.route(self.username, data, block)
+        return True
+
+    def close(self):
+        pass
+
+
+class WorkerBus:
+    '''
+    Worker-process side of the bus. A reader thread applies join/leave and
+    group events to the roster and groups, wakes up pending claims and hands
+    routed payloads to on_deliver(username, payload, block) through
+    `schedule`: the asyncio event loop's, or else a delivery thread's queue.
+    A delivery may wait for queue room, and the reader must never wait: the
+    hub blocks sending to a worker that stops reading, claims included.
+    '''
+
+    def __init__(self, path, worker_id):
+        self.path = path
+        self.worker_id = str(worker_id)
+        self.roster = None
+        self.groups = None
+        self.remote = {}  # username => RemoteOutbox for users on other workers
+        self.on_deliver = None
+        self.schedule = None
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._requests = itertools.count()
+        self._pending = {}  # request id => callback taking the result
+
+    def connect(self, roster, groups, on_deliver):
+        self.roster = roster
+        self.groups = groups
+        self.on_deliver = on_deliver
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.path)
+        if self.schedule is None:
+            deliveries = queue.SimpleQueue()
+            self.schedule = lambda *call: deliveries.put(call)
+            threading.Thread(target=self.deliver, args=(deliveries,), daemon=True).start()
+        self._send(encode_frame(f"hello {self.worker_id}"))
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    def deliver(self, deliveries):
+        while True:
+            function, *args = deliveries.get()
+            function(*args)
+
+    def _send(self, payload):
+        with self._send_lock:
+            self._sock.sendall(payload)
+
+    def claim(self, username):
+        """
+        Reserves username across the cluster. Returns None on success or the
+        error to send the client.
+        """
+        answered = threading.Event()
+        result = ["err_server_full"]
+
+        def done(answer):
+            result[0] = answer
+            answered.set()
+
+        if self._request_claim(username, done):
+            answered.wait()
+        return None if result[0] == "ok" else result[0]
+
+    async def claim_async(self, username):
+        """claim() for a coroutine: waits for the hub without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(answer):
+            if not future.done():
+                future.set_result(answer)
+
+        if self._request_claim(username, lambda answer: loop.call_soon_threadsafe(resolve, answer)):
+            answer = await future
+        else:
+            answer = "err_server_full"
+        return None if answer == "ok" else answer
+
+    def _request_claim(self, username, done):
+        """
+        Asks the hub for username; done(result) is called on the bus thread
+        when it answers. False if the request could not be sent.
+        """
+        request = str(next(self._requests))
+        self._pending[request] = done
+        try:
+            self._send(encode_frame(f"claim {username} {request}"))
+        except OSError:
+            self._pending.pop(request, None)
+            return False
+        return True
+
+    def release(self, username):
+        try:
+            self._send(encode_frame(f"release {username}"))
+        except OSError:
+            pass
+
+    def group_changed(self, cmd, username, group):
+        """Passes a local group_join or group_leave on to the other workers"""
+        try:
+            self._send(encode_frame(f"{cmd} {username} {group}"))
+        except OSError:
+            pass
+
+    def route(self, username, data, block=False):
+        """
+        Forwards a framed payload (or tuple of buffers) for another worker's
+        user; with block, the owning worker queues it with block=True
+        """
+        parts = flatten([data])
+        head = b"route " + username.encode() + (b" 1 " if block else b" 0 ")
+        try:
+            self._send(encode_frame(b"".join([head] + parts)))
+        except OSError:
+            pass
+
+    def receive(self):
+        buffer = FrameBuffer()
+        try:
+            while True:
+                frames = recv_frames(self._sock, buffer)
+                if frames is None:
+                    break
+                for frame in frames:
+                    self.handle(frame)
+        except (OSError, FrameError):
+            pass
+        finally:
+            # Without the hub no claim can ever be answered
+            for request in list(self._pending):
+                done = self._pending.pop(request, None)
+                if done is not None:
+                    done("err_server_full")
+
+    def handle(self, frame):
+        (cmd, name), payload = split_bus_header(frame, 2)
+        if cmd == "deliver":
+            (block,), payload = split_bus_header(payload, 1)
+            self.schedule(self.on_deliver, name, bytes(payload), block == "1")
+        elif cmd == "join":
+            if bytes(payload).decode() != self.worker_id:
+                self.remote[name] = RemoteOutbox(self, name)
+            self.roster.add(name)
+        elif cmd == "leave":
+            self.remote.pop(name, None)
+            self.roster.remove(name)
+            self.groups.leave_all(name)
+        elif cmd == "group_join":
+            self.groups.join(bytes(payload).decode(), name)
+        elif cmd == "group_leave":
+            self.groups.leave(bytes(payload).decode(), name)
+        elif cmd == "claimed":
+            done = self._pending.pop(name, None)
+            if done is not None:
+                done(bytes(payload).decode())
+
+
+class ClusterRegistry(ClientRegistry):
+    '''
+    ClientRegistry for a worker process: usernames are claimed through the
+    hub before being registered locally, and lookups fall back to users
+    connected to other workers. The roster is fed by the bus, not by local
+    joins, so it covers the whole cluster.
+    '''
+
+    def __init__(self, bus, shards=DEFAULT_SHARDS):
+        super().__init__(capacity=None, shards=shards)
+        self.bus = bus
+
+    def get_local(self, username):
+        """Outbox of a user connected to this worker, or None"""
+        return super().get(username)
+
+    def __contains__(self, username):
+        return super().__contains__(username) or username in self.bus.remote
+
+    def __getitem__(self, username):
+        outbox = self.get(username)
+        if outbox is None:
+            raise KeyError(username)
+        return outbox
+
+    def get(self, username, default=None):
+        outbox = super().get(username)
+        if outbox is None:
+            outbox = self.bus.remote.get(username, default)
+        return outbox
+
+    async def claim(self, username):
+        """
+        Claims username through the hub from a coroutine, ahead of the add()
+        that registers it in the same task; that add() then uses this claim
+        rather than blocking the event loop on the hub. Returns the error,
+        if any, the add() will return.
+        """
+        error = await self.bus.claim_async(username)
+        claimed.set((username, error))
+        return error
+
+    def drop_claim(self):
+        """Gives back a claim made by claim() that no add() went on to use"""
+        pending = claimed.get()
+        claimed.set(None)
+        if pending is not None and pending[1] is None:
+            self.bus.release(pending[0])
+
+    def add(self, username, outbox):
+        pending = claimed.get()
+        if pending is not None and pending[0] == username:
+            claimed.set(None)
+            error = pending[1]
+        else:
+            error = self.bus.claim(username)
+        if error:
+            return error
+        error = super().add(username, outbox)
+        if error:
+            self.bus.release(username)
+        return error
+
+    def remove(self, username, outbox=None):
+        removed = super().remove(username, outbox)
+        if removed is not None:
+            self.bus.release(username)
+        return removed
+
+
+def run_cluster(workers, capacity, start_worker):
+    """
+    Starts the hub, forks `workers` processes running start_worker(worker_id,
+    hub_path) and waits for them. Ctrl-C is passed on to the workers so they
+    can flush their output and exit.
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix="chat-hub-"), "hub.sock")
+    hub = Hub(path, capacity)
+
+    # Fork before the hub starts any threads; workers queue up in its backlog
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=start_worker, args=(i, path)) for i in range(workers)]
+    for process in processes:
+        process.start()
+    hub.start()
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in processes:
+            process.join(2.0)
+            if process.is_alive():
+                process.terminate()
+        raise
+    finally:
+        hub.close()
@@ -0,0 +1,102 @@
+'''
+Where the server's output lines (join:, msg:, disconnected: ...) go.
+'''
+
+import atexit
+import sys
+import threading
+
+SYNC = "sync"
+ASYNC = "async"
+MODES = (SYNC, ASYNC)
+
+
+class SyncLog:
+    '''
+    Writes each line straight to the stream in a single call; print() writes
+    the newline separately, so lines from concurrent handlers could run
+    together.
+    '''
+
+    def __init__(self, stream=None):
+        self._stream = stream
+
+    @property
+    def stream(self):
+        # Looked up on every write unless given, so redirecting stdout works
+        return self._stream or sys.stdout
+
+    def log(self, line):
+        self.stream.write(f"{line}\n")
+
+    def close(self):
+        self.stream.flush()
+
+
+class EventLog(SyncLog):
+    '''
+    Hands lines to a background writer thread, so handlers never wait on the
+    stream. Whatever piled up since the last write goes out as one write()
+    and flush(). At most `limit` lines are held: past that, log() waits for
+    the writer rather than dropping output. close() (also run at exit) writes
+    out everything still queued; lines logged after that are written
+    directly.
+    '''
+
+    def __init__(self, stream=None, limit=65536):
+        super().__init__(stream)
+        self.limit = limit
+        self._lines = []
+        self._closed = False
+        self._idle = False
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._room = threading.Condition(self._lock)
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def log(self, line):
+        with self._lock:
+            if self._closed:
+                self.stream.write(f"{line}\n")
+                return
+            while len(self._lines) >= self.limit and not self._closed:
+                self._room.wait()
+            self._lines.append(line)
+            if self._idle:
+                self._idle = False
+                self._ready.notify()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._ready.notify()
+            self._room.notify_all()
+        self._writer.join()
+        self.stream.flush()
+
+    def _write(self):
+        while True:
+            with self._lock:
+                while not self._lines and not self._closed:
+                    self._idle = True
+                    self._ready.wait()
+                lines, self._lines = self._lines, []
+                closed = self._closed
+                self._room.notify_all()
+
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    pass  # nowhere left to write; keep draining so log() never blocks
+            elif closed:
+                return
+
+
+def make_log(mode, stream=None):
+    return EventLog(stream) if mode == ASYNC else SyncLog(stream)
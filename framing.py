@@ -0,0 +1,193 @@
+'''
+Length-prefixed framing shared by the chat server and client.
+
+Every message on the wire is a 4 byte big-endian payload length followed by
+the payload itself, so a reader can split the byte stream back into exactly
+the messages that were sent no matter how TCP coalesces or splits them.
+
+When both ends agreed on compression at the handshake, the top bit of the
+length marks a payload that was zlib-compressed; readers inflate it back
+before handing the frame on, so nothing above this module ever sees it.
+'''
+
+import struct
+import time
+import zlib
+
+HEADER = struct.Struct("!I")
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_SIZE = 65536
+COMPRESSED = 0x80000000  # length flag: the payload is zlib-compressed
+COMPRESS_LEVEL = 1
+COMPRESS_THRESHOLD = 1024  # smaller payloads are not worth compressing
+COMPRESSION = "compress=zlib"  # hello option asking for compression, echoed back when accepted
+
+
+class FrameError(ValueError):
+    """Raised when a peer announces a frame larger than the allowed maximum"""
+
+
+def encode_frame(payload):
+    """Returns the payload (str or bytes) prefixed with its length header"""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_parts(*parts):
+    """Frames the concatenation of bytes-like parts, copying each just once"""
+    return b"".join((HEADER.pack(sum(map(len, parts))),) + parts)
+
+
+def compress_frame(data, level=COMPRESS_LEVEL):
+    """
+    Compresses a framed payload (bytes, or a tuple of buffers written back
+    to back) into a flagged frame. Returns None if that would not be smaller.
+    """
+    parts = data if isinstance(data, tuple) else (data,)
+    compressor = zlib.compressobj(level)
+    packed = [compressor.compress(memoryview(parts[0])[HEADER_SIZE:])]
+    packed.extend(compressor.compress(part) for part in parts[1:])
+    packed.append(compressor.flush())
+    size = sum(map(len, packed))
+    if size + HEADER_SIZE >= sum(map(len, parts)):
+        return None
+    return b"".join([HEADER.pack(size | COMPRESSED)] + packed)
+
+
+def inflate(payload, max_frame_size=MAX_FRAME_SIZE):
+    """Decompresses a flagged payload, refusing to grow it past the frame limit"""
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload, max_frame_size)
+    except zlib.error as e:
+        raise FrameError(f"bad compressed frame: {e}") from None
+    if decompressor.unconsumed_tail:
+        raise FrameError(f"compressed frame inflates past limit of {max_frame_size}")
+    if not decompressor.eof:
+        raise FrameError("truncated compressed frame")
+    return data
+
+
+def frame_length(length, max_frame_size=MAX_FRAME_SIZE):
+    """Splits a length header into (payload length, compressed), checking the limit"""
+    compressed = bool(length & COMPRESSED)
+    length &= ~COMPRESSED
+    if length > max_frame_size:
+        raise FrameError(f"frame of {length} bytes exceeds limit of {max_frame_size}")
+    return length, compressed
+
+
+class FrameBuffer:
+    '''
+    Per-connection reassembly buffer. feed() takes whatever a recv() returned
+    and hands back every frame it completed, as memoryviews over the received
+    bytes (compressed ones inflated). A partial frame is held back until the
+    rest of it arrives.
+    '''
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._chunks = []
+        self._buffered = 0
+        self._needed = HEADER_SIZE
+
+    def pending(self):
+        """Number of bytes still missing from the frame being reassembled"""
+        return self._needed - self._buffered
+
+    def feed(self, data):
+        """Adds received bytes and returns the list of completed frames"""
+        if not isinstance(data, bytes):
+            data = bytes(data)
+
+        if self._chunks:
+            self._chunks.append(data)
+            self._buffered += len(data)
+            if self._buffered < self._needed:
+                return []
+            data = b"".join(self._chunks)
+            self._chunks = []
+            self._buffered = 0
+
+        view = memoryview(data)
+        end = len(view)
+        offset = 0
+        frames = []
+        self._needed = HEADER_SIZE
+
+        while end - offset >= HEADER_SIZE:
+            length, compressed = frame_length(HEADER.unpack_from(view, offset)[0], self.max_frame_size)
+
+            start = offset + HEADER_SIZE
+            if end - start < length:
+                self._needed = HEADER_SIZE + length
+                break
+
+            frame = view[start:start + length]
+            frames.append(inflate(frame, self.max_frame_size) if compressed else frame)
+            offset = start + length
+
+        if offset < end:
+            rest = data[offset:]
+            self._chunks = [rest]
+            self._buffered = len(rest)
+        return frames
+
+
+def recv_frames(sock, buffer):
+    """
+    Reads from a blocking socket once and returns the frames completed by that
+    read, or None when the peer has closed the connection. The read is sized
+    to take the rest of a large frame in a single call.
+    """
+    data = sock.recv(max(RECV_SIZE, buffer.pending()))
+    if not data:
+        return None
+    return buffer.feed(data)
+
+
+def recv_exactly(sock, size, deadline=None):
+    """
+    Reads exactly size bytes from a blocking socket, or None on EOF. Given a
+    time.monotonic() deadline, raises TimeoutError once it has passed however
+    the bytes trickle in.
+    """
+    data = bytearray()
+    while len(data) < size:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("timed out")
+            sock.settimeout(remaining)
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock, max_frame_size=MAX_FRAME_SIZE, deadline=None):
+    """
+    Reads a single frame without consuming anything after it, or None on EOF
+    """
+    header = recv_exactly(sock, HEADER_SIZE, deadline)
+    if header is None:
+        return None
+    length, compressed = frame_length(HEADER.unpack(header)[0], max_frame_size)
+    payload = recv_exactly(sock, length, deadline)
+    return inflate(payload, max_frame_size) if compressed and payload is not None else payload
+
+
+async def read_frame(reader, max_frame_size=MAX_FRAME_SIZE):
+    """
+    Reads a single frame from an asyncio StreamReader, or None on EOF
+    """
+    try:
+        header = await reader.readexactly(HEADER_SIZE)
+        length, compressed = frame_length(HEADER.unpack(header)[0], max_frame_size)
+        payload = await reader.readexactly(length)
+        return inflate(payload, max_frame_size) if compressed else payload
+    except EOFError:
+        return None
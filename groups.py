@@ -0,0 +1,109 @@
+'''
+Named groups of users that a message can be sent to as a whole.
+'''
+
+import threading
+
+
+class Group:
+    '''
+    A group's members and, once someone has sent to it, the cached fan-out:
+    a frozen snapshot of the members and the outboxes they resolve to. The
+    cache is dropped whenever membership changes.
+    '''
+
+    def __init__(self):
+        self.members = set()
+        self.fanout = None  # (frozen members, outboxes)
+
+
+class GroupRegistry:
+    '''
+    Group name => Group, plus each user's memberships so a disconnecting user
+    can be dropped from all of their groups at once. lookup(username) resolves
+    a member to its outbox (or None) when a fan-out is built.
+
+    Changes take a single lock; fanout() only takes it to rebuild a cache, so
+    repeated sends to a group are one dict lookup and no per-member work.
+    '''
+
+    def __init__(self, lookup):
+        self.lookup = lookup
+        self._groups = {}
+        self._memberships = {}  # username => names of the groups they are in
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._groups)
+
+    def __contains__(self, name):
+        return name in self._groups
+
+    def members(self, name):
+        """Snapshot of a group's members, empty if it does not exist"""
+        group = self._groups.get(name)
+        return set(group.members) if group is not None else set()
+
+    def groups_of(self, username):
+        return set(self._memberships.get(username, ()))
+
+    def join(self, name, username):
+        """Adds username to the group, creating it. False if already a member"""
+        with self._lock:
+            group = self._groups.get(name)
+            if group is None:
+                group = self._groups[name] = Group()
+            if username in group.members:
+                return False
+            group.members.add(username)
+            group.fanout = None
+            self._memberships.setdefault(username, set()).add(name)
+            return True
+
+    def leave(self, name, username):
+        """Removes username from the group. False if they were not in it"""
+        with self._lock:
+            return self._leave(name, username)
+
+    def leave_all(self, username):
+        """Removes username from every group and returns their names"""
+        with self._lock:
+            names = list(self._memberships.get(username, ()))
+            for name in names:
+                self._leave(name, username)
+            return names
+
+    def _leave(self, name, username):
+        group = self._groups.get(name)
+        if group is None or username not in group.members:
+            return False
+        group.members.discard(username)
+        group.fanout = None
+        if not group.members:
+            del self._groups[name]
+
+        names = self._memberships[username]
+        names.discard(name)
+        if not names:
+            del self._memberships[username]
+        return True
+
+    def fanout(self, name):
+        """
+        (members, outboxes) of a group, or None if it does not exist. Both are
+        built on the first send after a membership change and shared by every
+        send until the next one: members is a frozenset that concurrent joins
+        and leaves never touch, and callers must not modify the outbox list.
+        """
+        group = self._groups.get(name)
+        if group is None:
+            return None
+        fanout = group.fanout
+        if fanout is None:
+            with self._lock:
+                if group.fanout is None:
+                    members = frozenset(group.members)
+                    found = (self.lookup(member) for member in members)
+                    group.fanout = (members, [outbox for outbox in found if outbox is not None])
+                fanout = group.fanout
+        return fanout
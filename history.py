@@ -0,0 +1,217 @@
+'''
+Persistent history of routed messages, for "last N messages" queries.
+
+Records go into numbered segment files under the history directory, each
+record length-prefixed like a frame on the wire:
+
+    <unix ms> <kind> <sender> <count> <recipient>... <body>
+
+Next to every segment an index file lists, per record, the offset of the
+record and each user it concerns. The index is what gets loaded into memory
+at startup (a few recent positions per user), so a query reads exactly the
+records it returns and never scans a segment.
+'''
+
+import array
+import atexit
+import os
+import struct
+import threading
+import time
+
+from framing import HEADER, HEADER_SIZE
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_SEGMENTS = 8
+DEFAULT_SYNC_INTERVAL = 1.0
+INDEX_LIMIT = 1024  # positions kept in memory per user
+INDEX_ENTRY = struct.Struct("!IH")  # record offset, username length, then the username
+
+
+def segment_path(directory, number, suffix):
+    return os.path.join(directory, f"{number:08d}.{suffix}")
+
+
+class History:
+    '''
+    Appends go to buffered segment and index files under one lock, so
+    recording a message only costs routing a copy into memory. A background
+    thread flushes and fsync()s both files every sync_interval seconds,
+    batching however many records arrived in between into one disk write; a
+    crash loses at most that window. Queries flush the buffer before reading.
+
+    Segments roll over at segment_size bytes and only the newest `segments`
+    are kept; positions into deleted segments are skipped and pruned.
+    '''
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, segments=DEFAULT_SEGMENTS,
+                 sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segments = segments
+        self.sync_interval = sync_interval
+        self._index = {}  # username => array of (segment << 32 | offset), oldest first
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._dirty = False
+        os.makedirs(directory, exist_ok=True)
+
+        numbers = sorted(
+            int(name.split(".")[0]) for name in os.listdir(directory) if name.endswith(".log")
+        )
+        for number in numbers[:-segments]:
+            self._remove(number)
+        numbers = numbers[-segments:]
+        for number in numbers:
+            self._load_index(number)
+
+        # Always start a fresh segment rather than appending after a tail a
+        # crash may have cut short
+        self._segment = numbers[-1] + 1 if numbers else 1
+        self._oldest = numbers[0] if numbers else self._segment
+        self._open_segment()
+
+        self._syncer = threading.Thread(target=self._sync_periodically, daemon=True)
+        self._syncer.start()
+        atexit.register(self.close)
+
+    def _load_index(self, number):
+        try:
+            with open(segment_path(self.directory, number, "idx"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        offset = 0
+        while len(data) - offset >= INDEX_ENTRY.size:
+            position, length = INDEX_ENTRY.unpack_from(data, offset)
+            offset += INDEX_ENTRY.size
+            if len(data) - offset < length:
+                break
+            username = data[offset:offset + length].decode(errors="replace")
+            offset += length
+            self._remember(username, number << 32 | position)
+
+    def _remember(self, username, position):
+        positions = self._index.get(username)
+        if positions is None:
+            positions = self._index[username] = array.array("Q")
+        positions.append(position)
+        if len(positions) > 2 * INDEX_LIMIT:
+            del positions[:-INDEX_LIMIT]
+
+    def _open_segment(self):
+        self._data = open(segment_path(self.directory, self._segment, "log"), "ab")
+        self._entries = open(segment_path(self.directory, self._segment, "idx"), "ab")
+        self._offset = 0
+
+    def _remove(self, number):
+        for suffix in ("log", "idx"):
+            try:
+                os.unlink(segment_path(self.directory, number, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _roll(self):
+        self._sync()
+        self._data.close()
+        self._entries.close()
+        self._segment += 1
+        self._open_segment()
+
+        while self._segment - self._oldest >= self.segments:
+            self._remove(self._oldest)
+            self._oldest += 1
+        floor = self._oldest << 32
+        for username in [u for u, positions in self._index.items() if positions[-1] < floor]:
+            del self._index[username]
+
+    def append(self, kind, sender, recipients, body, users):
+        """
+        Records one routed message. body is bytes-like; users are everyone
+        the record should be found under (normally the sender and recipients).
+        """
+        head = f"{int(time.time() * 1000)} {kind} {sender} {len(recipients)} {' '.join(recipients)} "
+        record = head.encode() + body
+        entries = []
+        with self._lock:
+            if self._closed.is_set():
+                return
+            if self._offset and self._offset + HEADER_SIZE + len(record) > self.segment_size:
+                self._roll()
+            position = self._segment << 32 | self._offset
+            for username in users:
+                name = username.encode()
+                entries.append(INDEX_ENTRY.pack(self._offset, len(name)) + name)
+                self._remember(username, position)
+            self._data.write(HEADER.pack(len(record)))
+            self._data.write(record)
+            self._entries.write(b"".join(entries))
+            self._offset += HEADER_SIZE + len(record)
+            self._dirty = True
+
+    def last(self, username, count):
+        """The user's last `count` records as bytes, oldest first"""
+        floor = self._oldest << 32
+        with self._lock:
+            positions = self._index.get(username, ())
+            wanted = [p for p in positions[-count:] if p >= floor]
+            if wanted and wanted[-1] >> 32 == self._segment:
+                self._data.flush()
+
+        records = []
+        files = {}
+        try:
+            for position in wanted:
+                number = position >> 32
+                if number not in files:
+                    try:
+                        files[number] = os.open(segment_path(self.directory, number, "log"), os.O_RDONLY)
+                    except FileNotFoundError:
+                        continue  # rolled away since
+                offset = position & 0xFFFFFFFF
+                header = os.pread(files[number], HEADER_SIZE, offset)
+                if len(header) < HEADER_SIZE:
+                    continue
+                (length,) = HEADER.unpack(header)
+                records.append(os.pread(files[number], length, offset + HEADER_SIZE))
+        finally:
+            for fd in files.values():
+                os.close(fd)
+        return records
+
+    def _sync(self):
+        if not self._dirty:
+            return
+        for f in (self._data, self._entries):
+            f.flush()
+            os.fsync(f.fileno())
+        self._dirty = False
+
+    def _sync_periodically(self):
+        while not self._closed.wait(self.sync_interval):
+            with self._lock:
+                if not self._dirty:
+                    continue
+                try:
+                    self._data.flush()
+                    self._entries.flush()
+                    # fsync() duplicates outside the lock, so appends never wait on the disk
+                    fds = [os.dup(f.fileno()) for f in (self._data, self._entries)]
+                except (OSError, ValueError):
+                    continue
+                self._dirty = False
+            for fd in fds:
+                try:
+                    os.fsync(fd)
+                except OSError:
+                    pass
+                os.close(fd)
+
+    def close(self):
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+            self._sync()
+            self._data.close()
+            self._entries.close()
@@ -0,0 +1,277 @@
+'''
+Lightweight runtime metrics for the chat server.
+'''
+
+import socket
+import sys
+import threading
+import time
+
+
+class RateMeter:
+    '''
+    Counts events in one-second buckets over a sliding window, so marking an
+    event is O(1) and rate() only ever looks at `window` buckets.
+    '''
+
+    def __init__(self, window=10):
+        self.window = window
+        self.total = 0
+        self._counts = [0] * window
+        self._seconds = [0] * window
+        self._lock = threading.Lock()
+
+    def mark(self, n=1):
+        """Records n events at the current time"""
+        now = int(time.monotonic())
+        slot = now % self.window
+        with self._lock:
+            if self._seconds[slot] != now:
+                self._seconds[slot] = now
+                self._counts[slot] = 0
+            self._counts[slot] += n
+            self.total += n
+
+    def rate(self):
+        """Average events per second over the window"""
+        now = int(time.monotonic())
+        with self._lock:
+            recent = sum(
+                count for count, second in zip(self._counts, self._seconds)
+                if now - second < self.window
+            )
+        return recent / self.window
+
+
+class Histogram:
+    '''
+    Latency histogram with power-of-two microsecond buckets: bucket i holds
+    values below 2**i us, so recording is a bit_length() and an increment.
+    Percentiles are reported as the upper bound of the bucket they fall in.
+    '''
+
+    BUCKETS = 32  # the last bucket catches everything from ~18 minutes up
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = [0] * self.BUCKETS
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        self.observe_many((seconds,))
+
+    def observe_many(self, values):
+        """Records several values under a single lock acquisition"""
+        last = self.BUCKETS - 1
+        with self._lock:
+            for seconds in values:
+                self._buckets[min(int(seconds * 1e6).bit_length(), last)] += 1
+                self.total += seconds
+                if seconds > self.max:
+                    self.max = seconds
+            self.count += len(values)
+
+    def percentile(self, p):
+        """Upper bound in seconds of the bucket holding the p-th percentile"""
+        with self._lock:
+            rank = self.count * p / 100
+            seen = 0
+            for i, n in enumerate(self._buckets):
+                seen += n
+                if n and seen >= rank:
+                    return min((1 << i) / 1e6, self.max)
+        return 0.0
+
+    def summary(self):
+        mean = self.total / self.count if self.count else 0.0
+        return {
+            "count": self.count,
+            "mean_us": round(mean * 1e6, 1),
+            "p50_us": round(self.percentile(50) * 1e6, 1),
+            "p99_us": round(self.percentile(99) * 1e6, 1),
+            "max_us": round(self.max * 1e6, 1),
+        }
+
+
+class Metrics:
+    '''
+    Named counters and histograms plus gauges computed on demand, shared by
+    every handler of one server process.
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def update(self, counts):
+        """Adds several counters at once; cheaper than one incr() each"""
+        with self._lock:
+            for name, n in counts.items():
+                self._counters[name] = self._counters.get(name, 0) + n
+
+    def histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def observe_many(self, name, values):
+        self.histogram(name).observe_many(values)
+
+    def gauge(self, name, read):
+        """Registers a callable whose value is read whenever stats are taken"""
+        self._gauges[name] = read
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+        stats = {"uptime_s": round(time.time() - self.started, 1)}
+        stats.update(sorted(counters.items()))
+        for name, read in sorted(self._gauges.items()):
+            try:
+                stats[name] = read()
+            except Exception as e:
+                stats[name] = f"error: {e}"
+        for name, histogram in sorted(self._histograms.items()):
+            for key, value in histogram.summary().items():
+                stats[f"{name}.{key}"] = value
+        return stats
+
+    def render(self):
+        """One `name value` line per statistic"""
+        return "".join(f"{name} {value}\n" for name, value in self.snapshot().items())
+
+
+class SamplingProfiler:
+    '''
+    Statistical profiler for every thread at once: a background thread looks
+    at each thread's current stack every `interval` seconds and counts the
+    functions it finds. Unlike cProfile it sees handler threads and costs
+    nothing while stopped.
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self._own = {}  # (file, line, function) => samples where it was running
+        self._total = {}  # (file, function) => samples where it was on the stack
+        self._stop = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.samples = 0
+        self._own = {}
+        self._total = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def toggle(self):
+        """Starts or stops profiling; returns the report when stopping"""
+        if self.running:
+            self.stop()
+            return self.report()
+        self.start()
+        return None
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                self.samples += 1
+                code = frame.f_code
+                key = (code.co_filename, frame.f_lineno, code.co_name)
+                self._own[key] = self._own.get(key, 0) + 1
+                seen = set()
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_filename, code.co_name)
+                    if key not in seen:
+                        seen.add(key)
+                        self._total[key] = self._total.get(key, 0) + 1
+                    frame = frame.f_back
+
+    def report(self, limit=20):
+        """Text table of the hottest lines and the functions most on the stack"""
+        if not self.samples:
+            return "no samples\n"
+        lines = [f"{self.samples} samples every {self.interval * 1000:g}ms\n", "self%  line\n"]
+        for (filename, lineno, name), n in sorted(self._own.items(), key=lambda kv: -kv[1])[:limit]:
+            lines.append(f"{100 * n / self.samples:5.1f}  {name} {filename}:{lineno}\n")
+        lines.append("total%  function\n")
+        for (filename, name), n in sorted(self._total.items(), key=lambda kv: -kv[1])[:limit]:
+            lines.append(f"{100 * n / self.samples:6.1f}  {name} {filename}\n")
+        return "".join(lines)
+
+
+class StatsServer:
+    '''
+    Serves the metrics as plain text over HTTP on a local port. GET /profile
+    starts the sampling profiler, or stops it and returns its report.
+    '''
+
+    def __init__(self, metrics, profiler, port, host="127.0.0.1"):
+        self.metrics = metrics
+        self.profiler = profiler
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen()
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    self._handle(conn)
+                except OSError:
+                    pass
+
+    def _handle(self, conn):
+        conn.settimeout(1.0)
+        request = conn.recv(1024).split()
+        path = request[1] if len(request) > 1 else b"/"
+        if path == b"/profile":
+            body = self.profiler.toggle() or "profiling started\n"
+        else:
+            body = self.metrics.render()
+        body = body.encode()
+        conn.sendall(
+            b"HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
@@ -0,0 +1,158 @@
+'''
+Store-and-forward for messages sent to users who are not connected.
+'''
+
+import fcntl
+import mmap
+import os
+import threading
+import time
+from urllib.parse import quote
+
+from framing import HEADER, HEADER_SIZE
+
+DEFAULT_USER_LIMIT = 1024 * 1024
+DEFAULT_MAX_USERS = 10000
+RECOUNT_INTERVAL = 10.0  # seconds before the file count is checked against the directory
+
+
+def split_frames(buffer):
+    """Views of the whole frames, header included, at the start of buffer"""
+    frames = []
+    end = complete_length(buffer, len(buffer))
+    offset = 0
+    while offset < end:
+        (length,) = HEADER.unpack_from(buffer, offset)
+        frames.append(buffer[offset:offset + HEADER_SIZE + length])
+        offset += HEADER_SIZE + length
+    return frames
+
+
+def complete_length(buffer, size):
+    """
+    Length of the run of whole frames at the start of buffer, so a frame
+    left half written by a crash is never replayed
+    """
+    offset = 0
+    while size - offset >= HEADER_SIZE:
+        (length,) = HEADER.unpack_from(buffer, offset)
+        if size - offset - HEADER_SIZE < length:
+            break
+        offset += HEADER_SIZE + length
+    return offset
+
+
+class OfflineStore:
+    '''
+    One append-only file per recipient under `directory`, holding the framed
+    messages exactly as they would have gone out. A returning user's backlog
+    is memory-mapped and handed to its outbox as a single buffer, so it goes
+    out in one batched write without being read into the heap.
+
+    Each file is capped at user_limit bytes: the oldest messages are evicted
+    to make room for new ones, down to half the cap at a time, so a full
+    backlog is rewritten once per half a cap of new messages rather than for
+    every message. At most max_users recipients can have messages
+    waiting. Files are locked with flock(), so the workers of a cluster (and
+    the threads of one server) can share a directory.
+
+    How many files there are is counted in memory as they are created and
+    taken, so the cap costs nothing per message. Other processes sharing the
+    directory make the count drift, so it is taken from the directory again
+    when it reaches the cap or is older than RECOUNT_INTERVAL.
+    '''
+
+    def __init__(self, directory, user_limit=DEFAULT_USER_LIMIT, max_users=DEFAULT_MAX_USERS):
+        self.directory = directory
+        self.user_limit = user_limit
+        self.max_users = max_users
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._recount()
+
+    def _recount(self):
+        self._files = len(os.listdir(self.directory))
+        self._counted_at = time.monotonic()
+
+    def _room(self):
+        """True if one more recipient may have messages waiting"""
+        with self._lock:
+            if self._files >= self.max_users or time.monotonic() - self._counted_at > RECOUNT_INTERVAL:
+                self._recount()
+            return self._files < self.max_users
+
+    def _counted(self, change):
+        with self._lock:
+            self._files = max(self._files + change, 0)
+
+    def path(self, username):
+        return os.path.join(self.directory, quote(username, safe="") + ".log")
+
+    def store(self, username, frame):
+        """
+        Appends one framed message to the user's backlog. Returns how many
+        older messages were evicted for it, or None if it was not stored.
+        """
+        if len(frame) > self.user_limit:
+            return None
+        path = self.path(username)
+        if not os.path.exists(path) and not self._room():
+            return None
+
+        while True:
+            with open(path, "ab+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    continue  # taken while we waited for the lock; start a new file
+
+                size = os.fstat(f.fileno()).st_size
+                if not size:
+                    self._counted(1)  # a new file, or one taken since we checked
+                evicted = 0
+                if size + len(frame) > self.user_limit:
+                    evicted = self._evict(f, size, size + len(frame) - self.user_limit // 2)
+                f.write(frame)
+                return evicted
+
+    def _evict(self, f, size, needed):
+        """Drops the oldest messages until at least `needed` bytes are free"""
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+            end = complete_length(mapped, size)
+            offset = evicted = 0
+            while offset < end and offset < needed:
+                (length,) = HEADER.unpack_from(mapped, offset)
+                offset += HEADER_SIZE + length
+                evicted += 1
+            kept = mapped[offset:end]
+        f.truncate(0)
+        f.write(kept)
+        return evicted
+
+    def take(self, username):
+        """
+        Removes and returns the user's backlog as a read-only memoryview of
+        whole frames, or None if nothing is waiting
+        """
+        path = self.path(username)
+        while True:
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                return None
+
+            with f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    continue  # someone else took it while we waited for the lock
+                # Unlinked under the lock: anything stored from now on starts a new file
+                os.unlink(path)
+                self._counted(-1)
+                size = os.fstat(f.fileno()).st_size
+                if not size:
+                    return None
+                mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                break
+
+        # The mapping outlives the file; it is unmapped once the view is dropped
+        end = complete_length(mapped, size)
+        return memoryview(mapped)[:end] if end else None
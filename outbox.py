@@ -0,0 +1,331 @@
+'''
+Per-recipient outbound queues.
+
+Every connected client owns an outbox. Senders only append already framed
+messages to it and return; a writer drains the queue and coalesces whatever
+has piled up into a single vectored write. A slow reader therefore only
+delays itself, and what happens once its queue is full is decided by the
+backpressure policy:
+
+    drop        the new message is discarded for that recipient
+    disconnect  the recipient is disconnected
+    block       the sender waits until the recipient's queue has room
+'''
+
+import asyncio
+import collections
+import contextvars
+import socket
+import threading
+import time
+
+DROP = "drop"
+DISCONNECT = "disconnect"
+BLOCK = "block"
+POLICIES = (DROP, DISCONNECT, BLOCK)
+
+IOV_MAX = 1024
+CLOSE_LINGER = 1.0
+
+# Async outboxes a coroutine overfilled under the block policy; the coroutine
+# awaits them before reading its next message
+congested = contextvars.ContextVar("congested", default=None)
+
+
+def flatten(batch):
+    """
+    Turns queued items, each a bytes-like object or a tuple of them, into one
+    list of buffers in send order
+    """
+    buffers = []
+    for item in batch:
+        if isinstance(item, tuple):
+            buffers.extend(item)
+        else:
+            buffers.append(item)
+    return buffers
+
+
+def sendmsg_all(sock, buffers):
+    """
+    writev()-style counterpart of socket.sendall for a list of buffers
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+
+    views = [memoryview(b).cast("B") for b in buffers]
+    start = 0
+    while start < len(views):
+        sent = sock.sendmsg(views[start:start + IOV_MAX])
+        while sent:
+            size = len(views[start])
+            if sent >= size:
+                sent -= size
+                start += 1
+            else:
+                views[start] = views[start][sent:]
+                sent = 0
+        while start < len(views) and not len(views[start]):
+            start += 1
+
+
+class Outbox:
+    '''
+    Bounded outbound queue for one client socket, drained by its own writer
+    thread. compress is set once the client has agreed to compressed frames.
+    Messages sent with a stamp (a time.perf_counter() value) have the time
+    until their write to the socket completed recorded in `latency`.
+    '''
+
+    compress = False
+
+    def __init__(self, sock, limit=1024, policy=DROP, on_overflow=None, on_drop=None, latency=None):
+        self.sock = sock
+        self.limit = limit
+        self.policy = policy
+        self.on_overflow = on_overflow
+        self.on_drop = on_drop  # called with the total dropped so far after each drop
+        self.latency = latency  # Histogram, or None
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._stamps = []  # of the queued messages that are being timed
+        self._cond = threading.Condition()
+        self._closed = False
+        self._writer = threading.Thread(target=self._drain, daemon=True)
+        self._writer.start()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def send(self, data, block=False, stamp=None):
+        """
+        Queues one framed message (bytes-like, or a tuple of buffers written
+        back to back). block=True applies the block policy to this message
+        whatever the configured one is. Returns False if it was not queued.
+        """
+        with self._cond:
+            while not self._closed and len(self._queue) >= self.limit:
+                if block or self.policy == BLOCK:
+                    self._cond.wait()
+                    continue
+                if self.policy == DROP:
+                    self.dropped += 1
+                    dropped = self.dropped
+                else:
+                    dropped = None
+                break
+            else:
+                if self._closed:
+                    return False
+                self._queue.append(data)
+                if stamp is not None:
+                    self._stamps.append(stamp)
+                self._cond.notify_all()
+                return True
+
+        if dropped is not None:
+            if self.on_drop:
+                self.on_drop(dropped)
+            return False
+        self.abort()
+        if self.on_overflow:
+            self.on_overflow()
+        return False
+
+    def offer(self, data):
+        """
+        Queues one framed message only if there is room right now, whatever
+        the policy: never waits, counts a drop or disconnects. Returns False
+        if it was not queued.
+        """
+        with self._cond:
+            if self._closed or len(self._queue) >= self.limit:
+                return False
+            self._queue.append(data)
+            self._cond.notify_all()
+            return True
+
+    def close(self):
+        """
+        Lets the writer flush what is already queued, then closes the socket
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if threading.current_thread() is not self._writer:
+            self._writer.join(CLOSE_LINGER)
+        self._shutdown()
+
+    def abort(self):
+        """Discards anything queued and closes the socket right away"""
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+        self._shutdown()
+
+    def _shutdown(self):
+        # shutdown() also wakes a reader or writer blocked on this socket
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _drain(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                batch = flatten(self._queue)
+                self._queue.clear()
+                stamps = self._stamps
+                if stamps:
+                    self._stamps = []
+                self._cond.notify_all()
+
+            try:
+                sendmsg_all(self.sock, batch)
+            except OSError:
+                self.abort()
+                return
+            if stamps and self.latency is not None:
+                written = time.perf_counter()
+                self.latency.observe_many([written - stamp for stamp in stamps])
+
+
+class AsyncOutbox:
+    '''
+    Event-loop counterpart of Outbox for an asyncio StreamWriter, drained by a
+    writer task. Under the block policy the message is still queued, and the
+    sending coroutine waits for the queue to empty before reading more input.
+    Timed messages are recorded once the transport has drained them.
+    '''
+
+    compress = False
+
+    def __init__(self, writer, limit=1024, policy=DROP, on_overflow=None, on_drop=None, latency=None):
+        self.writer = writer
+        self.limit = limit
+        self.policy = policy
+        self.on_overflow = on_overflow
+        self.on_drop = on_drop
+        self.latency = latency
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._stamps = []  # of the queued messages that are being timed
+        self._flushed = []  # of the timed messages handed to the transport
+        self._closed = False
+        self._wakeup = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._task = asyncio.get_running_loop().create_task(self._drain())
+
+    def __len__(self):
+        return len(self._queue)
+
+    def send(self, data, block=False, stamp=None):
+        """
+        Queues one framed message. block=True applies the block policy to this
+        message whatever the configured one is. Returns False if it was not
+        queued.
+        """
+        if self._closed:
+            return False
+
+        if len(self._queue) >= self.limit and not self._transport_full():
+            # The writer task just hasn't run yet; the transport can take it
+            self._flush()
+
+        if len(self._queue) >= self.limit and not block:
+            if self.policy == DROP:
+                self.dropped += 1
+                if self.on_drop:
+                    self.on_drop(self.dropped)
+                return False
+            if self.policy == DISCONNECT:
+                self.abort()
+                if self.on_overflow:
+                    self.on_overflow()
+                return False
+
+        if len(self._queue) >= self.limit:
+            self._writable.clear()
+            waiting = congested.get()
+            if waiting is not None:
+                waiting.append(self)
+
+        self._queue.append(data)
+        if stamp is not None:
+            self._stamps.append(stamp)
+        self._wakeup.set()
+        return True
+
+    def offer(self, data):
+        """
+        Queues one framed message only if there is room, whatever the policy.
+        Returns False if it was not queued.
+        """
+        if self._closed:
+            return False
+        if len(self._queue) >= self.limit and not self._transport_full():
+            self._flush()
+        if len(self._queue) >= self.limit:
+            return False
+        self._queue.append(data)
+        self._wakeup.set()
+        return True
+
+    def _transport_full(self):
+        transport = self.writer.transport
+        return transport.get_write_buffer_size() >= transport.get_write_buffer_limits()[1]
+
+    def _flush(self):
+        batch = flatten(self._queue)
+        self._queue.clear()
+        if self._stamps:
+            self._flushed.extend(self._stamps)
+            self._stamps = []
+        self._writable.set()
+        self.writer.writelines(batch)
+
+    async def wait_writable(self):
+        """Waits until the queue has been handed to the transport"""
+        await self._writable.wait()
+
+    def close(self):
+        """Flushes what is already queued, then closes the stream"""
+        self._closed = True
+        self._wakeup.set()
+
+    def abort(self):
+        """Discards anything queued and drops the connection right away"""
+        self._closed = True
+        self._queue.clear()
+        self._writable.set()
+        self._wakeup.set()
+        self.writer.transport.abort()
+
+    async def _drain(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                if self._queue:
+                    self._flush()
+                    await self.writer.drain()
+                if self._flushed and self.latency is not None:
+                    drained = time.perf_counter()
+                    self.latency.observe_many([drained - stamp for stamp in self._flushed])
+                self._flushed = []
+                if self._closed and not self._queue:
+                    break
+        except (ConnectionError, OSError):
+            self._closed = True
+            self._queue.clear()
+        finally:
+            self._writable.set()
+            self.writer.close()
@@ -0,0 +1,143 @@
+'''
+Parsing of the commands clients send, straight from the received frame.
+
+Only the header words (command, recipient count, recipients, filename...) are
+copied and decoded; a message body is handed back as a view of the received
+bytes, so it is never decoded, split or joined on its way to the recipients.
+'''
+
+from dataclasses import dataclass, field
+
+HEAD_SIZE = 1024
+
+
+@dataclass
+class Command:
+    name: str
+    recipients: list = field(default_factory=list)
+    filename: str = None
+    size: int = None
+    page: int = None
+    group: str = None
+    count: int = None
+    body: memoryview = None
+
+
+def split_header(frame, fields, limit=HEAD_SIZE):
+    """
+    Splits the first `fields` whitespace separated words off a frame and
+    returns them decoded, along with a view of the frame from the first
+    non-whitespace byte after them. Only the head of the frame is copied,
+    growing it when the words run past it (a long recipient list). A frame
+    no longer than the head is split in one go, its rest coming back as bytes.
+    """
+    if len(frame) <= limit:
+        # Short frame, the usual chat message: one copy and one split, with the
+        # same (ASCII) separators as below, and the rest comes back as bytes
+        parts = bytes(frame).split(None, fields)
+        rest = parts.pop() if len(parts) > fields else b""
+        return [word.decode() for word in parts], rest
+
+    view = memoryview(frame)
+    while True:
+        head = bytes(view[:limit])
+        parts = head.split(None, fields)
+        if len(parts) > fields:
+            rest = len(head) - len(parts[fields])
+            return list(map(bytes.decode, parts[:fields])), view[rest:]
+        if len(head) == len(view):
+            return list(map(bytes.decode, parts)), view[len(view):]
+        limit *= 4
+
+
+def parse_count(word):
+    count = int(word)
+    if count < 0:
+        raise ValueError(f"negative count {count}")
+    return count
+
+
+PARSERS = {}  # command name => function filling in its arguments
+
+
+def parses(name):
+    """Registers the argument parser of a command"""
+    def register(function):
+        PARSERS[name] = function
+        return function
+    return register
+
+
+@parses("msg")
+def parse_msg(command, argument, rest):
+    # msg <count> <recipient>... <body>
+    if argument is None:
+        raise ValueError("msg without recipients")
+    command.recipients, command.body = split_header(rest, parse_count(argument))
+    if not command.recipients and not command.body:
+        raise ValueError("msg without recipients")
+
+
+@parses("file")
+def parse_file(command, argument, rest):
+    # file <count> <recipient>... <filename> <size>
+    if argument is None:
+        raise ValueError("file without recipients")
+    count = parse_count(argument)
+    words, _ = split_header(rest, count + 2)
+    if len(words) < count + 2:
+        raise ValueError("file without a filename and size")
+    command.recipients = words[:count]
+    command.filename = words[count]
+    command.size = parse_count(words[count + 1])
+
+
+@parses("list")
+def parse_list(command, argument, rest):
+    # list [page]
+    if argument is not None:
+        command.page = int(argument)
+        if command.page < 1:
+            raise ValueError(f"page {command.page} out of range")
+
+
+@parses("history")
+def parse_history(command, argument, rest):
+    # history [count]
+    if argument is not None:
+        command.count = int(argument)
+        if command.count < 1:
+            raise ValueError(f"history of {command.count} messages")
+
+
+@parses("group_join")
+@parses("group_leave")
+def parse_group(command, argument, rest):
+    # group_join <group>, group_leave <group>
+    if argument is None:
+        raise ValueError(f"{command.name} without a group")
+    command.group = argument
+
+
+@parses("group_msg")
+def parse_group_msg(command, argument, rest):
+    # group_msg <group> <body>
+    parse_group(command, argument, rest)
+    command.body = rest
+
+
+def parse_command(frame):
+    """
+    Parses one client command frame. Returns None for an empty frame and
+    raises ValueError for a command with malformed arguments. Commands
+    without a registered parser come back with just their name.
+    """
+    # Every command with arguments starts with one plain word: a count or page
+    words, rest = split_header(frame, 2)
+    if not words:
+        return None
+    command = Command(words[0])
+    parse = PARSERS.get(command.name)
+    if parse is not None:
+        parse(command, words[1] if len(words) > 1 else None, rest)
+    return command
@@ -0,0 +1,122 @@
+'''
+Finding connections that have gone quiet, so a half-open client doesn't hold
+its slot (and, in thread mode, its handler thread) forever.
+'''
+
+import math
+import threading
+import time
+
+TICKS_PER_TIMEOUT = 8  # resolution of the wheel: an eighth of the timeout
+
+
+class Watch:
+    '''
+    One watched connection. Handlers only ever write last_seen, and busy
+    while they are handling what they received, which can block on a slow
+    recipient for longer than the timeout.
+    '''
+
+    __slots__ = ("username", "outbox", "last_seen", "busy", "pinged_at", "slot")
+
+    def __init__(self, username, outbox, now):
+        self.username = username
+        self.outbox = outbox
+        self.last_seen = now
+        self.busy = False
+        self.pinged_at = None
+        self.slot = None
+
+
+class IdleReaper:
+    '''
+    Hashed timing wheel of watched connections. Every connection sits in the
+    slot of the tick at which it may next have been quiet for `timeout`
+    seconds, so a tick only looks at the connections due in its own slot, and
+    watching, unwatching and rescheduling are set operations.
+
+    Traffic never touches the wheel: handlers just stamp last_seen, and a due
+    connection that turns out to have been heard from is moved to the slot
+    it is really due in. A busy connection counts as heard from just now. A
+    connection quiet for `timeout` gets on_idle(watch) (the server sends a
+    ping); if it is still quiet another `timeout` later it gets on_dead(watch).
+    '''
+
+    def __init__(self, timeout, on_idle, on_dead, clock=time.monotonic):
+        self.timeout = timeout
+        self.tick_interval = timeout / TICKS_PER_TIMEOUT
+        self.on_idle = on_idle
+        self.on_dead = on_dead
+        self.clock = clock
+        self._slots = [set() for _ in range(TICKS_PER_TIMEOUT + 2)]
+        self._current = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def watch(self, username, outbox):
+        watch = Watch(username, outbox, self.clock())
+        with self._lock:
+            self._schedule(watch, self.timeout)
+            self._count += 1
+        return watch
+
+    def unwatch(self, watch):
+        with self._lock:
+            if watch.slot is not None:
+                self._slots[watch.slot].discard(watch)
+                watch.slot = None
+                self._count -= 1
+
+    def _schedule(self, watch, delay):
+        ticks = min(max(1, math.ceil(delay / self.tick_interval)), len(self._slots) - 1)
+        watch.slot = (self._current + ticks) % len(self._slots)
+        self._slots[watch.slot].add(watch)
+
+    def tick(self):
+        """Advances the wheel by one slot and deals with the connections due in it"""
+        now = self.clock()
+        idle, dead = [], []
+        with self._lock:
+            self._current = (self._current + 1) % len(self._slots)
+            due = self._slots[self._current]
+            self._slots[self._current] = set()
+            for watch in due:
+                if watch.busy:
+                    watch.pinged_at = None
+                    self._schedule(watch, self.timeout)
+                    continue
+                quiet = now - watch.last_seen
+                if watch.pinged_at is not None and watch.last_seen > watch.pinged_at:
+                    watch.pinged_at = None  # answered
+                if quiet < self.timeout:
+                    self._schedule(watch, self.timeout - quiet)
+                elif watch.pinged_at is None:
+                    watch.pinged_at = now
+                    self._schedule(watch, self.timeout)
+                    idle.append(watch)
+                elif now - watch.pinged_at >= self.timeout:
+                    watch.slot = None
+                    self._count -= 1
+                    dead.append(watch)
+                else:
+                    self._schedule(watch, self.timeout - (now - watch.pinged_at))
+
+        for watch in idle:
+            self.on_idle(watch)
+        for watch in dead:
+            self.on_dead(watch)
+
+    def run(self, schedule=None):
+        """
+        Ticks forever on the calling thread; with schedule (an event loop's
+        call_soon_threadsafe) each tick runs wherever that puts it
+        """
+        while True:
+            time.sleep(self.tick_interval)
+            if schedule:
+                schedule(self.tick)
+            else:
+                self.tick()
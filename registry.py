@@ -0,0 +1,88 @@
+'''
+Registry of connected clients, keyed by username.
+'''
+
+import threading
+
+DEFAULT_SHARDS = 16
+
+
+class ClientRegistry:
+    '''
+    Username => outbox map split into shards that each have their own lock.
+
+    Lookups take no lock at all, since reading a dict is atomic. Joins and
+    leaves only lock the shard the username hashes to, plus a short critical
+    section on the user count so the capacity check stays exact. on_join and
+    on_leave run under the shard lock, so anything they maintain (the roster)
+    sees a name's joins and leaves in the order they happened.
+    '''
+
+    def __init__(self, capacity=None, shards=DEFAULT_SHARDS, on_join=None, on_leave=None):
+        self.capacity = capacity
+        self.on_join = on_join
+        self.on_leave = on_leave
+        self._shards = [{} for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._count = 0
+        self._count_lock = threading.Lock()
+
+    def _index(self, username):
+        return hash(username) % len(self._shards)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, username):
+        return username in self._shards[self._index(username)]
+
+    def __getitem__(self, username):
+        return self._shards[self._index(username)][username]
+
+    def get(self, username, default=None):
+        return self._shards[self._index(username)].get(username, default)
+
+    def keys(self):
+        """Snapshot of every registered username, in no particular order"""
+        return [name for shard in self._shards for name in list(shard)]
+
+    def add(self, username, outbox):
+        """
+        Registers the outbox under username. Returns None on success, or the
+        error to send the client: err_server_full or err_username_unavailable.
+        """
+        with self._count_lock:
+            if self.capacity is not None and self._count >= self.capacity:
+                return "err_server_full"
+            self._count += 1
+
+        i = self._index(username)
+        with self._locks[i]:
+            if username not in self._shards[i]:
+                self._shards[i][username] = outbox
+                if self.on_join:
+                    self.on_join(username)
+                return None
+
+        with self._count_lock:
+            self._count -= 1
+        return "err_username_unavailable"
+
+    def remove(self, username, outbox=None):
+        """
+        Unregisters username and returns its outbox, or None if it was not
+        registered. When an outbox is given, a different connection that has
+        since taken the same username is left alone.
+        """
+        i = self._index(username)
+        with self._locks[i]:
+            current = self._shards[i].get(username)
+            if current is None or (outbox is not None and current is not outbox):
+                return None
+            del self._shards[i][username]
+            if self.on_leave:
+                self.on_leave(username)
+
+        with self._count_lock:
+            self._count -= 1
+        return current
@@ -0,0 +1,77 @@
+'''
+Sorted roster of connected usernames backing the `list` command.
+'''
+
+import bisect
+import threading
+
+from framing import encode_frame
+
+DEFAULT_PAGE_SIZE = 100
+
+
+class Roster:
+    '''
+    Usernames kept in sorted order as clients join and leave, so `list` never
+    sorts. The framed responses are cached per page and only rebuilt after
+    membership changes.
+    '''
+
+    def __init__(self, page_size=DEFAULT_PAGE_SIZE):
+        if page_size < 1:
+            raise ValueError(f"page size {page_size} is not positive")
+        self.page_size = page_size
+        self._names = []
+        self._cache = {}  # page (None for the whole roster) => framed response
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        i = bisect.bisect_left(self._names, name)
+        return i < len(self._names) and self._names[i] == name
+
+    def add(self, name):
+        with self._lock:
+            i = bisect.bisect_left(self._names, name)
+            if i < len(self._names) and self._names[i] == name:
+                return
+            self._names.insert(i, name)
+            self._cache = {}
+
+    def remove(self, name):
+        with self._lock:
+            i = bisect.bisect_left(self._names, name)
+            if i < len(self._names) and self._names[i] == name:
+                del self._names[i]
+                self._cache = {}
+
+    def names(self):
+        """Snapshot of the roster in sorted order"""
+        with self._lock:
+            return list(self._names)
+
+    def pages(self):
+        return max(1, -(-len(self._names) // self.page_size))
+
+    def response(self, page=None):
+        """
+        Framed `list:` response for the whole roster, or for one 1-based page
+        of it as `list: <page>/<pages> <names>`
+        """
+        cached = self._cache.get(page)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            if page is None:
+                payload = encode_frame("list: " + " ".join(self._names))
+            else:
+                start = (page - 1) * self.page_size
+                names = self._names[start:start + self.page_size]
+                payload = encode_frame(f"list: {page}/{self.pages()} " + " ".join(names))
+                if page > self.pages():
+                    return payload  # don't let out-of-range pages grow the cache
+            self._cache[page] = payload
+        return payload
@@ -4,11 +4,33 @@ Chat server implementation for CS 382 PA1.
 Handles multiple clients via sockets.
 """
 
+import os
 import sys
+import time
+import signal
 import socket
-from dataclasses import dataclass
+import asyncio
+import resource
+import itertools
+from dataclasses import dataclass, field
 import argparse
 import threading
+from admission import RETRY_AFTER, AdmissionControl
+from eventlog import MODES as LOG_MODES, SYNC, make_log
+from cluster import ClusterRegistry, WorkerBus, run_cluster
+from framing import (
+    COMPRESS_THRESHOLD, COMPRESSION, HEADER, HEADER_SIZE, FrameBuffer, FrameError, compress_frame,
+    encode_frame, encode_parts, read_frame, recv_frame, recv_frames,
+)
+from groups import GroupRegistry
+from history import DEFAULT_SYNC_INTERVAL, History
+from metrics import Metrics, RateMeter, SamplingProfiler, StatsServer
+from offline import DEFAULT_USER_LIMIT, OfflineStore, split_frames
+from outbox import DROP, POLICIES, AsyncOutbox, Outbox, congested
+from protocol import parse_command
+from reaper import IdleReaper
+from registry import ClientRegistry
+from roster import DEFAULT_PAGE_SIZE, Roster
 
 try:
     import util  
@@ -18,6 +40,43 @@ except ImportError:
     print("Warning: util.py not found. Using default MAX_CLIENTS = 10")
     MAX_CLIENTS = 10
 
+LATENCY_SAMPLE = 16  # time the delivery of one in this many fan-outs
+HISTORY_DEFAULT = 10  # records "history" returns without a count
+HISTORY_LIMIT = 100  # most records one "history" returns
+HANDLERS = {}  # command name => Server method handling it
+UNKNOWN_COMMAND = encode_frame("err_unknown_command")
+HELLO_SIZE = 1024  # largest hello a client may send before it has a name
+REJECTIONS = {  # join error => why the server says the client was disconnected
+    "err_server_full": "server full",
+    "err_username_unavailable": "username not available",
+}
+PING = encode_frame("ping")
+PONG = encode_frame("pong")
+
+
+def handles(name):
+    """
+    Registers a Server method as the handler of a client command. Each
+    command also needs a parser in protocol unless it takes no arguments.
+    """
+    def register(method):
+        HANDLERS[name] = method
+        return method
+    return register
+
+
+@dataclass
+class FileTransfer:
+    '''
+    A file a client is streaming through the server: the outboxes its chunks
+    go to, how many bytes are still to come and the prefix that tags each
+    relayed chunk with the sender.
+    '''
+    outboxes: list
+    remaining: int
+    prefix: bytes
+
+
 @dataclass
 class Server:
     '''
@@ -25,147 +84,723 @@ class Server:
     '''
     server_addr: str
     server_port: int
-    sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    clients: dict = None
-    lock: threading.Lock = threading.Lock()
+    sock: socket.socket = field(default_factory=lambda: socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+    clients: ClientRegistry = None
+    handshake_timeout: float = 5.0
+    accept_rate: RateMeter = None
+    queue_size: int = 1024
+    backpressure: str = DROP
+    list_page_size: int = DEFAULT_PAGE_SIZE
+    reuse_port: bool = False
+    bus: WorkerBus = None
+    max_clients: int = MAX_CLIENTS
+    backlog: int = None
+    max_memory: int = None
+    max_queued: int = None
+    retry_after: float = RETRY_AFTER
+    stats_port: int = None
+    stats_interval: float = None
+    log_mode: str = SYNC
+    offline_dir: str = None
+    offline_limit: int = DEFAULT_USER_LIMIT
+    history_dir: str = None
+    history_sync_interval: float = DEFAULT_SYNC_INTERVAL
+    compress_threshold: int = COMPRESS_THRESHOLD
+    idle_timeout: float = None
 
     
     def __post_init__(self):
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Allow port reuse
+            if self.reuse_port:
+                # Let several worker processes listen on the same port
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.sock.settimeout(None)
             self.sock.bind((self.server_addr, self.server_port))
-            self.sock.listen(MAX_CLIENTS)
-            self.clients = {}
+            # Connections waiting to be accepted; how many users may join is max_clients
+            self.sock.listen(self.backlog or socket.SOMAXCONN)
+            self.transfers = {}
+            self.roster = Roster(self.list_page_size)
+            if self.bus:
+                self.clients = ClusterRegistry(self.bus)
+            else:
+                self.clients = ClientRegistry(
+                    self.max_clients or None, on_join=self.roster.add, on_leave=self.roster.remove
+                )
+            self.groups = GroupRegistry(self.clients.get)
+            self.offline = OfflineStore(self.offline_dir, self.offline_limit) if self.offline_dir else None
+            self.history = (
+                History(self.history_dir, sync_interval=self.history_sync_interval)
+                if self.history_dir else None
+            )
+            self.reaper = (
+                IdleReaper(self.idle_timeout, on_idle=self.ping, on_dead=self.reap)
+                if self.idle_timeout else None
+            )
+            self.admission = (
+                AdmissionControl(lambda: sum(self.queue_depths()), self.max_memory, self.max_queued)
+                if self.max_memory is not None or self.max_queued is not None else None
+            )
+            self.accept_rate = RateMeter()
+            self.events = make_log(self.log_mode)
+            self.metrics = Metrics()
+            self.profiler = SamplingProfiler()
+            self.send_calls = itertools.count()
+            # Bound once here so dispatch is a single dict lookup per command
+            self.handlers = {
+                name: (getattr(self, method.__name__), f"commands.{name}")
+                for name, method in HANDLERS.items()
+            }
+            self.unknown_handler = (self.handle_unknown, "commands.unknown")
+            self.metrics.gauge("active_connections", lambda: len(self.clients))
+            self.metrics.gauge("roster_size", lambda: len(self.roster))
+            self.metrics.gauge("groups", lambda: len(self.groups))
+            self.metrics.gauge("accepts_per_sec", self.accept_rate.rate)
+            self.metrics.gauge("queue_depth_total", lambda: sum(self.queue_depths()))
+            self.metrics.gauge("queue_depth_max", lambda: max(self.queue_depths(), default=0))
+            self.metrics.gauge("profiling", lambda: int(self.profiler.running))
+            if self.reaper is not None:
+                self.metrics.gauge("watched_connections", lambda: len(self.reaper))
 
     def start(self):
         """
-        Main server loop that accepts client connections and spawns handler threads
+        Main server loop that accepts client connections and spawns handler threads.
+        The username handshake happens on the handler thread, so a client that
+        never sends its name cannot hold up anyone else's join.
         """
+        raise_fd_limit()
+        self.start_stats()
+        self.join_cluster()
+        self.start_reaper()
         while True:
             client_socket, _ = self.sock.accept()
-            username = client_socket.recv(1024).decode().strip()
+            self.accept_rate.mark()
+            threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
+
+    def close(self):
+        """
+        Writes out what is still buffered on the way out: queued output lines
+        and history records not yet fsync()ed
+        """
+        self.events.close()
+        if self.history is not None:
+            self.history.close()
+
+    def log(self, line):
+        """Writes one line of server output, e.g. `join: <username>`"""
+        self.events.log(line)
+
+    def start_stats(self):
+        """
+        Starts whichever ways of reading the metrics were asked for, and lets
+        SIGUSR1 toggle the sampling profiler
+        """
+        if self.stats_port is not None:
+            StatsServer(self.metrics, self.profiler, self.stats_port).start()
+        if self.stats_interval:
+            threading.Thread(target=self.dump_stats, daemon=True).start()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda *_: self.toggle_profiler())
+
+    def start_reaper(self, schedule=None):
+        """
+        Starts ticking the idle reaper on its own thread, if there is one.
+        schedule, an event loop's call_soon_threadsafe, runs each tick there.
+        """
+        if self.reaper is not None:
+            threading.Thread(target=self.reaper.run, args=(schedule,), daemon=True).start()
+
+    def ping(self, watch):
+        """
+        Asks a client that has gone quiet whether it is still there. The ping
+        is only queued if there is room: this runs on the reaper, which must
+        never wait, and a quiet client with a full queue isn't reading anyway,
+        so it goes unanswered and the client is reaped like any other.
+        """
+        self.metrics.incr("idle_pings")
+        watch.outbox.offer(PING)
+
+    def reap(self, watch):
+        """
+        Drops a client that stayed quiet after a ping. Anything still queued
+        for it is discarded, since the peer is presumed gone.
+        """
+        self.metrics.incr("idle_reaped")
+        self.log(f"Client {watch.username} timed out")
+        watch.outbox.abort()
+        self.disconnect_client(watch.username, watch.outbox)
+
+    def dump_stats(self):
+        """Writes the metrics to stderr every stats_interval seconds"""
+        while True:
+            time.sleep(self.stats_interval)
+            sys.stderr.write(f"--- stats ---\n{self.metrics.render()}")
+            sys.stderr.flush()
 
-            with self.lock:
-                if len(self.clients) >= MAX_CLIENTS:
-                    client_socket.send("err_server_full".encode())
-                    client_socket.close()
-                    continue
+    def toggle_profiler(self):
+        report = self.profiler.toggle()
+        sys.stderr.write(report or "--- profiling started ---\n")
+        sys.stderr.flush()
 
-                if username in self.clients:
-                    client_socket.send("err_username_unavailable".encode())
-                    client_socket.close()
-                    continue
+    def queue_depths(self):
+        """Messages waiting in each local client's outbox"""
+        depths = []
+        for username in self.clients.keys():
+            outbox = self.clients.get(username)
+            if outbox is not None:
+                depths.append(len(outbox))
+        return depths
 
-                self.clients[username] = client_socket
+    def join_cluster(self):
+        """
+        Connects a worker process to the hub; a no-op for a standalone server
+        """
+        if self.bus:
+            self.bus.connect(self.roster, self.groups, self.deliver_local)
+
+    def deliver_local(self, username, payload, block=False):
+        """
+        Delivers a payload another worker routed to one of our clients;
+        block is set for frames the sender would have queued with block=True
+        """
+        outbox = self.clients.get_local(username)
+        if outbox is not None:
+            self.send(payload, [outbox], block)
+
+    def handshake(self, client_socket):
+        """
+        Reads the hello (username and options) a new client sends first,
+        giving up handshake_timeout seconds after it started, however slowly
+        the bytes trickle in. Returns an empty string on failure.
+        """
+        try:
+            deadline = time.monotonic() + self.handshake_timeout
+            frame = recv_frame(client_socket, HELLO_SIZE, deadline)
+            client_socket.settimeout(None)
+            return frame.decode().strip() if frame is not None else ""
+        except (OSError, FrameError, UnicodeDecodeError):
+            return ""
 
-            print(f"join: {username}")
+    def make_outbox(self, client_socket, username):
+        """
+        Creates the outbound queue that every message for this client goes through
+        """
+        outbox = Outbox(
+            client_socket, self.queue_size, self.backpressure,
+            on_overflow=lambda: self.disconnect_client(username, outbox),
+            on_drop=lambda dropped: self.report_drop(username, dropped),
+            latency=self.metrics.histogram("delivery_latency"),
+        )
+        return outbox
+
+    def report_drop(self, username, dropped):
+        """
+        Counts a message the drop policy discarded for a full outbox. The log
+        gets the 1st, 2nd, 4th, 8th... drop for each client, so a stalled
+        reader can't flood it.
+        """
+        self.metrics.incr("messages_dropped")
+        if dropped & (dropped - 1) == 0:
+            self.log(f"dropped: {dropped} message(s) for {username}, outbox full")
 
-            threading.Thread(target=self.handle_client, args=(client_socket, username), daemon=True).start()
+    def parse_hello(self, hello):
+        """
+        Splits a client's hello into its username and whether it offered
+        compression: "<username>" or "<username> compress=zlib"
+        """
+        words = hello.split()
+        if not words:
+            return "", False
+        return words[0], COMPRESSION in words[1:] and self.compress_threshold > 0
+
+    def register_client(self, username, client_socket, compress=False):
+        """
+        Admits a client under the given username and returns its outbox. If the
+        server is full or too loaded, or the name is taken, the client is sent
+        an error, its connection is closed and None is returned. A client that
+        offered compression gets the offer echoed back as the first frame.
+        """
+        outbox = self.make_outbox(client_socket, username)
+        error = self.admit() or self.clients.add(username, outbox)
+        if error:
+            self.metrics.incr(f"joins_rejected.{error}")
+            self.log(f"disconnected: {REJECTIONS.get(error, error)}")
+            if error == "err_server_full":
+                # Tells the client when trying again is worthwhile
+                error = f"{error} retry_after={self.retry_after:g}"
+            outbox.send(encode_frame(error))
+            outbox.close()
+            return None
+
+        if compress:
+            outbox.send(encode_frame(COMPRESSION))
+            outbox.compress = True
+        self.metrics.incr("joins")
+        self.log(f"join: {username}")
+        self.flush_offline(username, outbox)
+        return outbox
+
+    def admit(self):
+        """
+        err_server_full while the server is over one of its load limits,
+        otherwise None; the user count itself is checked by the registry
+        """
+        if self.admission is None:
+            return None
+        reason = self.admission.check()
+        if reason is None:
+            return None
+        self.metrics.incr(f"joins_shed.{reason}")
+        return "err_server_full"
+
+    def flush_offline(self, username, outbox):
+        """
+        Sends a joining user whatever was stored for them while they were
+        away, as one buffer. It waits for queue room rather than being dropped.
+        """
+        if self.offline is None:
+            return
+        backlog = self.offline.take(username)
+        if backlog is not None:
+            # Several frames back to back, so queued as is rather than through
+            # send(), which may compress what it is given as a single frame
+            self.metrics.update({"offline_flushed": 1, "bytes_out": len(backlog)})
+            self.queue(backlog, [outbox], True)
 
-    def handle_client(self, client_socket, username):
+    def handle_client(self, client_socket):
         """
         Handles communication with a single client
         """
+        username, compress = self.parse_hello(self.handshake(client_socket))
+        if not username:
+            client_socket.close()
+            return
+
+        outbox = self.register_client(username, client_socket, compress)
+        if outbox is None:
+            return
+
+        watch = self.reaper.watch(username, outbox) if self.reaper is not None else None
+        buffer = FrameBuffer()
         try:
             while True:
-                message = client_socket.recv(1024).decode()
+                frames = recv_frames(client_socket, buffer)
 
-                if not message:
+                if frames is None:
                     break  # Client disconnected
-                
-                if message.strip() == "quit":
-                    break
-                    
-                self.process_message(username, message)
+                if watch is not None:
+                    # Never idle while a send below waits on a slow recipient
+                    watch.busy = True
+
+                for frame in frames:
+                    self.metrics.incr("bytes_in", HEADER_SIZE + len(frame))
+                    if self.relay_chunk(username, frame):
+                        continue
+
+                    if self.process_message(username, frame) == "quit":
+                        return
+
+                if watch is not None:
+                    watch.last_seen = time.monotonic()
+                    watch.busy = False
 
         except (ConnectionResetError, BrokenPipeError) as e:
-            print(f"Client {username} disconnected unexpectedly: {e}")
-        except OSError as e:
-            print(f"Error with {username}: {e}")
+            self.log(f"Client {username} disconnected unexpectedly: {e}")
+        except (OSError, FrameError, UnicodeDecodeError) as e:
+            self.log(f"Error with {username}: {e}")
         finally:
-            self.disconnect_client(username)
+            if watch is not None:
+                self.reaper.unwatch(watch)
+            self.disconnect_client(username, outbox)
 
     def process_message(self, sender, msg):
         """
-        Processes messages from clients and routes them appropriately
+        Parses a command from a client and hands it to the handler registered
+        for it. Returns the name of the command, or None if it was malformed.
+        """
+        if isinstance(msg, str):
+            msg = msg.encode()
+        try:
+            command = parse_command(msg)
+        except ValueError:
+            self.metrics.incr("commands.malformed")
+            return None
+        if command is None:
+            return None
+
+        handler, counter = self.handlers.get(command.name, self.unknown_handler)
+        self.metrics.incr(counter)
+        handler(sender, command)
+        return command.name
+
+    @handles("msg")
+    def handle_msg(self, sender, command):
+        self.log(f"msg: {sender}")
+        # The body goes from the received frame into the outgoing one in a single copy
+        payload = encode_parts(b"msg ", sender.encode(), b" ", command.body)
+        self.deliver(payload, command.recipients, sender, keep=True)
+        self.record("msg", sender, command.recipients, command.body)
+
+    @handles("list")
+    def handle_list(self, sender, command):
+        # "list" sends the whole roster, "list <page>" one page of it
+        self.log(f"request_users_list: {sender}")
+        self.reply(sender, self.roster.response(command.page))
+
+    @handles("file")
+    def handle_file(self, sender, command):
+        # Important: Log the file transfer for the test to check
+        self.log(f"file: {sender}")
+
+        self.start_transfer(sender, command.recipients, command.filename, command.size)
+        self.record("file", sender, command.recipients, f"{command.filename} {command.size}".encode())
+
+    @handles("group_join")
+    @handles("group_leave")
+    def handle_group_change(self, sender, command):
+        self.log(f"{command.name}: {sender} {command.group}")
+        if command.name == "group_join":
+            changed = self.groups.join(command.group, sender)
+        else:
+            changed = self.groups.leave(command.group, sender)
+        if changed and self.bus:
+            self.bus.group_changed(command.name, sender, command.group)
+
+    @handles("group_msg")
+    def handle_group_msg(self, sender, command):
+        """
+        Sends to every member of a group but the sender, through the group's
+        cached outboxes instead of a recipient list sent with each message
+        """
+        self.log(f"group_msg: {sender} {command.group}")
+        fanout = self.groups.fanout(command.group)
+        if fanout is None:
+            self.metrics.incr("undeliverable")
+            self.log(f"group_msg: {sender} to non-existent group {command.group}")
+            return
+        members, outboxes = fanout
+        if sender in members:
+            own = self.clients.get(sender)
+            outboxes = [outbox for outbox in outboxes if outbox is not own]
+
+        payload = encode_parts(
+            b"group_msg ", command.group.encode(), b" ", sender.encode(), b" ", command.body
+        )
+        self.send(payload, outboxes, kind="group_msg")
+        self.record("group_msg", sender, [command.group], command.body, members)
+
+    @handles("history")
+    def handle_history(self, sender, command):
+        """Sends the sender their last messages, sent or received, oldest first"""
+        if self.history is None:
+            self.handle_unknown(sender, command)
+            return
+        self.log(f"history: {sender}")
+        count = min(command.count or HISTORY_DEFAULT, HISTORY_LIMIT)
+        for record in self.history.last(sender, count):
+            self.reply(sender, encode_parts(b"history ", record))
+
+    def record(self, kind, sender, recipients, body, members=None):
+        """
+        Adds a routed message to the history, found under the sender and the
+        recipients (or a group's members)
+        """
+        if self.history is None:
+            return
+        users = {sender, *(recipients if members is None else members)}
+        try:
+            self.history.append(kind, sender, recipients, body, users)
+        except (OSError, ValueError) as e:
+            self.log(f"Error recording {kind} from {sender}: {e}")
+
+    @handles("ping")
+    def handle_ping(self, sender, command):
+        self.reply(sender, PONG)
+
+    @handles("pong")
+    def handle_pong(self, sender, command):
+        pass  # receiving it already counted as activity
+
+    @handles("quit")
+    def handle_quit(self, sender, command):
+        self.disconnect_client(sender)
+
+    def handle_unknown(self, sender, command):
+        self.reply(sender, UNKNOWN_COMMAND)
+
+    def reply(self, username, payload):
+        """Sends a framed payload back to a connected client"""
+        outbox = self.clients.get(username)
+        if outbox is not None:
+            self.send(payload, [outbox])
+
+    def deliver(self, payload, recipients, sender, kind="msg", block=False, keep=False):
+        """
+        Hands one framed payload to every recipient's outbox and returns those
+        outboxes. All of them share the same immutable bytes, so the message is
+        formatted and encoded once no matter how many recipients it has. With
+        keep, it is stored for recipients that are not connected.
+        """
+        outboxes = self.lookup(recipients, sender, kind, payload if keep else None)
+        return self.send(payload, outboxes, block, kind)
+
+    def lookup(self, recipients, sender, kind="msg", keep=None):
+        """
+        Outboxes of the recipients that are connected, logging the rest and
+        storing `keep` for them when there is an offline store
         """
-        msg_parts = msg.split()
-        if len(msg_parts) < 1:
+        outboxes = []
+        for recipient in recipients:
+            outbox = self.clients.get(recipient)
+            if outbox is None:
+                self.metrics.incr("undeliverable")
+                self.log(f"{kind}: {sender} to non-existent user {recipient}")
+                if keep is not None and self.offline is not None:
+                    self.store_offline(recipient, keep)
+            else:
+                outboxes.append(outbox)
+        return outboxes
+
+    def store_offline(self, recipient, payload):
+        try:
+            evicted = self.offline.store(recipient, payload)
+        except OSError as e:
+            self.log(f"Error storing message for {recipient}: {e}")
             return
-            
-        cmd = msg_parts[0]
-
-        if cmd == "msg":
-            if len(msg_parts) < 3:
-                return
-                
-            try:
-                num_recipients = int(msg_parts[1])
-                recipients = msg_parts[2:2+num_recipients]
-                message = " ".join(msg_parts[2+num_recipients:])
-                print(f"msg: {sender}")
-                
-                for recipient in recipients:
-                    if recipient in self.clients:
-                        try:
-                            self.clients[recipient].send(f"msg {sender} {message}".encode())
-                        except OSError:
-                            print(f"Error sending message to {recipient}")
-                    else:
-                        print(f"msg: {sender} to non-existent user {recipient}")
-            except (ValueError, IndexError):
-                return
-
-        elif cmd == "list":
-            print(f"request_users_list: {sender}")
-            users = " ".join(sorted(self.clients.keys()))
-            try:
-                self.clients[sender].send(f"list: {users}".encode())
-            except OSError:
-                print(f"Error sending user list to {sender}")
-
-        elif cmd == "file":
-            try:
-                num_recipients = int(msg_parts[1])
-                recipients = msg_parts[2:2+num_recipients]
-                filename = msg_parts[2+num_recipients]
-                file_contents = " ".join(msg_parts[3+num_recipients:])
-                
-                # Important: Log the file transfer for the test to check
-                print(f"file: {sender}")
-                
-                for recipient in recipients:
-                    if recipient in self.clients:
-                        try:
-                            self.clients[recipient].send(f"file: {sender} {filename} {file_contents}".encode())
-                        except OSError:
-                            print(f"Error sending file to {recipient}")
-                    else:
-                        print(f"msg: {sender} to non-existent user {recipient}")
-            except (ValueError, IndexError):
-                return
-
-        elif cmd == "quit":
-            self.disconnect_client(sender)
-
-    def disconnect_client(self, username):
-        """
-        Safely disconnects a client and removes them from the clients dictionary
-        """
-        with self.lock:
-            if username in self.clients:
-                try:
-                    if self.clients[username]:
-                        self.clients[username].close()
-                except OSError as e:
-                    print(f"Error closing socket for {username}: {e}")
-                del self.clients[username]
-                print(f"disconnected: {username}")
+        if evicted is None:
+            self.metrics.incr("offline_rejected")
+            return
+        self.metrics.update({"offline_stored": 1, "offline_evicted": evicted})
 
+        # The recipient may have joined, and taken their backlog, since they
+        # were looked up; nothing else would flush this message until they
+        # join again. Sent frame by frame, since they may be on another worker.
+        outbox = self.clients.get(recipient)
+        if outbox is not None:
+            backlog = self.offline.take(recipient)
+            if backlog is not None:
+                for frame in split_frames(backlog):
+                    self.send(frame, [outbox], block=True)
 
+    def send(self, data, outboxes, block=False, kind=None):
+        """
+        Queues data on each outbox and returns them, counting the bytes that
+        went out and, given a kind, the deliveries as routed.<kind>. Frames of
+        at least compress_threshold bytes are compressed once for all the
+        recipients that agreed to it at the handshake.
+        """
+        size = len(data) if not isinstance(data, tuple) else sum(len(part) for part in data)
+        counts = {"bytes_out": size * len(outboxes)}
+        if kind:
+            counts[f"routed.{kind}"] = len(outboxes)
 
+        packed = None
+        if self.compress_threshold and size >= self.compress_threshold:
+            compressing = [outbox for outbox in outboxes if outbox.compress]
+            if compressing:
+                packed = compress_frame(data)
+        if packed is None:
+            self.queue(data, outboxes, block)
+        else:
+            self.queue(data, [outbox for outbox in outboxes if not outbox.compress], block)
+            self.queue(packed, compressing, block)
+            saved = (size - len(packed)) * len(compressing)
+            counts["bytes_out"] -= saved
+            counts["bytes_saved_compressed"] = saved
 
+        self.metrics.update(counts)
+        return outboxes
 
+    def queue(self, data, outboxes, block):
+        """
+        Hands data to each outbox. Every LATENCY_SAMPLE-th call is stamped
+        so each recipient's writer records, as delivery_latency, how long it
+        took from here until the write to the client's socket completed.
+        """
+        if next(self.send_calls) % LATENCY_SAMPLE:
+            for outbox in outboxes:
+                outbox.send(data, block=block)
+        else:
+            stamp = time.perf_counter()
+            for outbox in outboxes:
+                outbox.send(data, block=block, stamp=stamp)
+
+    def start_transfer(self, sender, recipients, filename, size):
+        """
+        Announces a file to its recipients. The sender follows the header with
+        raw chunk frames adding up to size bytes, which relay_chunk forwards.
+        """
+        header = encode_frame(f"file: {sender} {filename} {size}")
+        outboxes = self.deliver(header, recipients, sender, kind="file", block=True)
+        if size:
+            self.transfers[sender] = FileTransfer(outboxes, size, f"chunk {sender} ".encode())
+
+    def relay_chunk(self, sender, chunk):
+        """
+        Forwards one frame of the sender's file transfer without decoding or
+        copying it: recipients get a small "chunk <sender> " prefix followed by
+        a view of the received bytes. File chunks always wait for queue room
+        rather than being dropped, so server memory is bounded by the queue
+        size however large the file is. Returns False if the sender has no
+        transfer in progress.
+        """
+        transfer = self.transfers.get(sender)
+        if transfer is None:
+            return False
+
+        chunk = memoryview(chunk)[:transfer.remaining]
+        transfer.remaining -= len(chunk)
+        if transfer.remaining <= 0:
+            del self.transfers[sender]
+
+        header = HEADER.pack(len(transfer.prefix) + len(chunk)) + transfer.prefix
+        self.send((header, chunk), transfer.outboxes, block=True, kind="chunk")
+        return True
+
+    def disconnect_client(self, username, outbox=None):
+        """
+        Safely disconnects a client and removes them from the client registry.
+        When an outbox is given, only that connection is removed, not a newer
+        one that has since taken the same username.
+        """
+        outbox = self.clients.remove(username, outbox)
+        if outbox is None:
+            return
+        self.transfers.pop(username, None)
+        self.groups.leave_all(username)
+        self.metrics.incr("disconnects")
+
+        self.log(f"disconnected: {username}")
+
+        try:
+            outbox.close()
+        except OSError as e:
+            self.log(f"Error closing socket for {username}: {e}")
+
+
+@dataclass
+class AsyncServer(Server):
+    '''
+    Event-loop variant of Server. Every connection is served by a coroutine on
+    a single asyncio loop instead of a dedicated thread, so an idle client only
+    costs a task and its stream buffers rather than a thread stack.
+    '''
+
+    def start(self):
+        """
+        Runs the event loop that accepts and serves every client connection
+        """
+        raise_fd_limit()
+        asyncio.run(self.serve())
+
+    def make_outbox(self, writer, username):
+        """
+        Creates a task-drained outbound queue for the client's stream writer
+        """
+        outbox = AsyncOutbox(
+            writer, self.queue_size, self.backpressure,
+            on_overflow=lambda: self.disconnect_client(username, outbox),
+            on_drop=lambda dropped: self.report_drop(username, dropped),
+            latency=self.metrics.histogram("delivery_latency"),
+        )
+        return outbox
+
+    async def serve(self):
+        """
+        Serves connections on the already bound listening socket forever
+        """
+        if self.bus:
+            # Deliveries from other workers arrive on the bus thread
+            self.bus.schedule = asyncio.get_running_loop().call_soon_threadsafe
+        self.start_stats()
+        self.join_cluster()
+        self.start_reaper(asyncio.get_running_loop().call_soon_threadsafe)
+        server = await asyncio.start_server(self.handle_connection, sock=self.sock)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Coroutine counterpart of handle_client for a single connection
+        """
+        self.accept_rate.mark()
+        try:
+            frame = await asyncio.wait_for(read_frame(reader, HELLO_SIZE), self.handshake_timeout)
+            hello = frame.decode().strip() if frame is not None else ""
+        except (OSError, FrameError, UnicodeDecodeError, asyncio.TimeoutError, asyncio.CancelledError):
+            hello = ""
+        username, compress = self.parse_hello(hello)
+        if not username:
+            writer.close()
+            return
+
+        if self.bus:
+            # Ask the hub for the name without stalling every other connection
+            await self.clients.claim(username)
+        try:
+            outbox = self.register_client(username, writer, compress)
+        finally:
+            if self.bus:
+                self.clients.drop_claim()
+        if outbox is None:
+            return
+
+        watch = self.reaper.watch(username, outbox) if self.reaper is not None else None
+        waiting = []
+        congested.set(waiting)
+        try:
+            while True:
+                message = await read_frame(reader)
+
+                if message is None:
+                    break  # Client disconnected
+                if watch is not None:
+                    # Never idle while waiting below for a slow recipient
+                    watch.busy = True
+
+                self.metrics.incr("bytes_in", HEADER_SIZE + len(message))
+                if not self.relay_chunk(username, message):
+                    if self.process_message(username, message) == "quit":
+                        break
+
+                # Block policy: stop reading until overfull recipients catch up
+                for congested_outbox in waiting:
+                    await congested_outbox.wait_writable()
+                waiting.clear()
+                if watch is not None:
+                    watch.last_seen = time.monotonic()
+                    watch.busy = False
+
+        except (ConnectionResetError, BrokenPipeError) as e:
+            self.log(f"Client {username} disconnected unexpectedly: {e}")
+        except (OSError, FrameError, UnicodeDecodeError) as e:
+            self.log(f"Error with {username}: {e}")
+        except asyncio.CancelledError:
+            pass  # the server is shutting down; clean up without a traceback
+        finally:
+            if watch is not None:
+                self.reaper.unwatch(watch)
+            self.disconnect_client(username, outbox)
+
+
+def raise_fd_limit():
+    """
+    Lifts the soft open-file limit to the hard limit so a single process can
+    hold as many client sockets as the system allows
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def positive_int(value):
+    """argparse type for options that must be a whole number above zero"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
 
 
 # Do not change this part of code
@@ -183,14 +818,189 @@ if __name__ == "__main__":
         default="localhost",
         help="The server IP or hostname, defaults to localhost"
     )
+    parser.add_argument(
+        "-m", "--mode",
+        choices=["thread", "asyncio"],
+        default="thread",
+        help="Serve clients with one thread each or from a single asyncio event loop, defaults to thread"
+    )
+    parser.add_argument(
+        "--handshake-timeout",
+        type=float,
+        default=5.0,
+        help="Seconds a new connection has to send its username, defaults to 5"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=1024,
+        help="Messages that may wait in a client's outbound queue, defaults to 1024"
+    )
+    parser.add_argument(
+        "--backpressure",
+        choices=POLICIES,
+        default=DROP,
+        help="What to do when a client's outbound queue is full, defaults to drop"
+    )
+    parser.add_argument(
+        "--list-page-size",
+        type=positive_int,
+        default=DEFAULT_PAGE_SIZE,
+        help=f"Usernames per page for 'list <page>', defaults to {DEFAULT_PAGE_SIZE}"
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=1,
+        help="Worker processes sharing the port via SO_REUSEPORT, defaults to 1"
+    )
+
+    parser.add_argument(
+        "--max-clients",
+        type=int,
+        default=MAX_CLIENTS,
+        help=f"Most users connected at once, 0 for no limit, defaults to {MAX_CLIENTS}"
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=None,
+        help="Connections the kernel queues until they are accepted, "
+             f"defaults to the system maximum ({socket.SOMAXCONN})"
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=None,
+        help="Turn new users away while the process uses this many MiB or more"
+    )
+    parser.add_argument(
+        "--max-queued",
+        type=int,
+        default=None,
+        help="Turn new users away while this many messages or more wait in outboxes"
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=float,
+        default=RETRY_AFTER,
+        help=f"Seconds a turned-away client is told to wait, defaults to {RETRY_AFTER}"
+    )
+
+    parser.add_argument(
+        "--log-mode",
+        choices=LOG_MODES,
+        default=SYNC,
+        help="'async' hands output lines to a background writer instead of "
+             "writing them on the handler, defaults to sync"
+    )
+    parser.add_argument(
+        "--stats-port",
+        type=int,
+        default=None,
+        help="Serve metrics as text on this local port; GET /profile toggles profiling"
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=None,
+        help="Also write the metrics to stderr every this many seconds"
+    )
+
+    parser.add_argument(
+        "--offline-dir",
+        type=str,
+        default=None,
+        help="Keep messages to users who are not connected in this directory "
+             "and send them when the user joins"
+    )
+    parser.add_argument(
+        "--offline-limit",
+        type=int,
+        default=DEFAULT_USER_LIMIT,
+        help=f"Bytes kept per offline user, oldest dropped first, defaults to {DEFAULT_USER_LIMIT}"
+    )
+
+    parser.add_argument(
+        "--history-dir",
+        type=str,
+        default=None,
+        help="Record every routed msg and file in this directory, for 'history [count]'"
+    )
+    parser.add_argument(
+        "--history-sync-interval",
+        type=float,
+        default=DEFAULT_SYNC_INTERVAL,
+        help=f"Seconds between fsyncs of the history, defaults to {DEFAULT_SYNC_INTERVAL}"
+    )
+
+    parser.add_argument(
+        "--compress-threshold",
+        type=int,
+        default=COMPRESS_THRESHOLD,
+        help="Compress frames of at least this many bytes for clients that offer it, "
+             f"0 to turn compression off, defaults to {COMPRESS_THRESHOLD}"
+    )
+
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=None,
+        help="Ping a client after this many quiet seconds and drop it if it stays quiet "
+             "as long again, defaults to never"
+    )
 
     args = parser.parse_args()
     PORT = args.port
     DEST = args.address
 
-    SERVER = Server(DEST, PORT)
+    def make_server(**kwargs):
+        return (AsyncServer if args.mode == "asyncio" else Server)(
+            DEST, PORT,
+            handshake_timeout=args.handshake_timeout,
+            queue_size=args.queue_size,
+            backpressure=args.backpressure,
+            list_page_size=args.list_page_size,
+            max_clients=args.max_clients,
+            backlog=args.backlog,
+            max_memory=args.max_memory * 1024 * 1024 if args.max_memory is not None else None,
+            max_queued=args.max_queued,
+            retry_after=args.retry_after,
+            stats_interval=args.stats_interval,
+            log_mode=args.log_mode,
+            offline_dir=args.offline_dir,
+            offline_limit=args.offline_limit,
+            history_sync_interval=args.history_sync_interval,
+            compress_threshold=args.compress_threshold,
+            idle_timeout=args.idle_timeout,
+            **kwargs,
+        )
+
+    def start_worker(worker_id, hub_path):
+        # Each worker serves its own stats on the next port up
+        stats_port = args.stats_port + worker_id if args.stats_port is not None else None
+        # Each worker keeps its own history; two processes can't share one log
+        history_dir = os.path.join(args.history_dir, f"worker{worker_id}") if args.history_dir else None
+        server = make_server(
+            reuse_port=True, bus=WorkerBus(hub_path, worker_id), stats_port=stats_port,
+            history_dir=history_dir,
+        )
+        try:
+            server.start()
+        except (KeyboardInterrupt, SystemExit):
+            # Forked workers skip atexit, so write out queued lines and records here
+            server.close()
+            sys.stdout.flush()
+
+    SERVER = None
     try:
-        SERVER.start()
+        if args.workers > 1:
+            run_cluster(args.workers, args.max_clients or None, start_worker)
+        else:
+            SERVER = make_server(stats_port=args.stats_port, history_dir=args.history_dir)
+            SERVER.start()
     except (KeyboardInterrupt, SystemExit):
+        if SERVER is not None:
+            SERVER.close()
         print("Exception occurred. Exiting...")
         sys.exit()